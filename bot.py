@@ -1,13 +1,22 @@
 import logging
+import bisect
+import hmac
+import json
+import random
 import sqlite3
 import asyncio
 import aiohttp
 import os
+import signal
 import sys
+import threading
 import time
-from datetime import datetime, timedelta
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
+from collections import OrderedDict, deque
+from aiohttp import web
+from concurrent.futures import ThreadPoolExecutor
+from telegram import Update, Message, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from telegram.ext import Application, BasePersistence, BaseUpdateProcessor, PersistenceInput, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler, ChatMemberHandler
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -25,6 +34,7 @@ if not BOT_TOKEN or BOT_TOKEN == "your_bot_token_here":
 logger.info(f"✅ Токен бота загружен. Длина: {len(BOT_TOKEN)} символов")
 
 CHANNEL_USERNAME = "@wexxi_code"
+CHANNEL_MEMBER_STATUSES = ('member', 'administrator', 'creator')
 MAIN_PHOTO_URL = "https://postimg.cc/5jp2NNDX"
 
 # Данные
@@ -43,54 +53,455 @@ BINANCE_SYMBOLS = {
     "BNB": "BNBUSDT", "SOL": "SOLUSDT", "ADA": "ADAUSDT", "DOGE": "DOGEUSDT"
 }
 
-# Кэширование
-price_cache = {}
-CACHE_DURATION = timedelta(seconds=30)
+# Режим получения обновлений: polling или webhook
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '')  # публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/telegram')
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('PORT', 8080))
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')
+# Сколько обновлений обрабатывается одновременно (обновления одного пользователя - по очереди)
+CONCURRENT_UPDATES = int(os.environ.get('CONCURRENT_UPDATES', 64))
 
-class Database:
+if BOT_MODE == 'webhook' and not WEBHOOK_SECRET:
+    # Без секрета любой, кто достучится до порта, сможет подделать обновления от чужого имени
+    logger.error("❌ WEBHOOK_SECRET не установлен - режим webhook без него не запускается!")
+    sys.exit(1)
+
+# chat_member не входит в обновления по умолчанию - запрашиваем явно
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY, Update.CHAT_MEMBER]
+
+# Перезапуск после сбоя: задержка растет от минимальной до максимальной
+RESTART_MIN_DELAY = float(os.environ.get('RESTART_MIN_DELAY', 5))
+RESTART_MAX_DELAY = float(os.environ.get('RESTART_MAX_DELAY', 300))
+
+# Кэширование (время в секундах)
+PRICE_CACHE_TTL = float(os.environ.get('PRICE_CACHE_TTL', 30))
+FX_CACHE_TTL = float(os.environ.get('FX_CACHE_TTL', 300))
+# Курсы к USD на случай, если ни один источник курсов не ответил с момента запуска
+FX_FALLBACK_RATES = {"usd": 1.0, "rub": 95.0, "eur": 0.92, "kzt": 450.0, "uah": 38.0, "byn": 2.5}
+PRICE_CACHE_MAX_SIZE = int(os.environ.get('PRICE_CACHE_MAX_SIZE', 1000))
+# Сколько устаревшее значение еще можно показывать, пока идет фоновое обновление
+CACHE_STALE_SECONDS = float(os.environ.get('CACHE_STALE_SECONDS', 600))
+# Фоновый прогрев всех пар CRYPTO_CURRENCIES × TARGET_CURRENCIES до истечения кэша
+PRICE_CACHE_WARMUP = os.environ.get('PRICE_CACHE_WARMUP', '1') == '1'
+
+# База данных
+DB_PATH = os.environ.get('DB_PATH', 'crypto_bot.db')
+DB_BUSY_TIMEOUT = float(os.environ.get('DB_BUSY_TIMEOUT', 5))
+DB_LOCK_RETRIES = int(os.environ.get('DB_LOCK_RETRIES', 3))
+DB_CACHED_STATEMENTS = 256
+
+# Кэш языков пользователей (LRU, ~100 байт на запись)
+LANGUAGE_CACHE_SIZE = int(os.environ.get('LANGUAGE_CACHE_SIZE', 200000))
+LANGUAGE_CACHE_PRELOAD = os.environ.get('LANGUAGE_CACHE_PRELOAD', '1') == '1'
+
+# Кэш username пользователей для текста уведомлений (LRU)
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 200000))
+
+# Кэш подписки на канал: "подписан" живет долго, "не подписан" - недолго,
+# чтобы только что подписавшийся пользователь не ждал истечения записи
+MEMBERSHIP_POSITIVE_TTL = float(os.environ.get('MEMBERSHIP_POSITIVE_TTL', 6 * 3600))
+MEMBERSHIP_NEGATIVE_TTL = float(os.environ.get('MEMBERSHIP_NEGATIVE_TTL', 10))
+MEMBERSHIP_CACHE_SIZE = int(os.environ.get('MEMBERSHIP_CACHE_SIZE', 100000))
+
+# История цен
+PRICE_HISTORY_STEP = int(os.environ.get('PRICE_HISTORY_STEP', 10))  # не чаще одной точки на пару за N секунд
+PRICE_HISTORY_FLUSH_INTERVAL = float(os.environ.get('PRICE_HISTORY_FLUSH_INTERVAL', 15))
+PRICE_HISTORY_BUFFER_SIZE = int(os.environ.get('PRICE_HISTORY_BUFFER_SIZE', 50000))
+# Сырые точки нужны только для последней цены, долгая история хранится свечами
+PRICE_HISTORY_RAW_RETENTION = int(os.environ.get('PRICE_HISTORY_RAW_RETENTION_HOURS', 2)) * 3600
+# Интервал свечи (секунды) -> сколько секунд их хранить
+PRICE_CANDLE_RETENTION = {
+    60: int(os.environ.get('PRICE_CANDLES_1M_RETENTION_DAYS', 7)) * 86400,
+    3600: int(os.environ.get('PRICE_CANDLES_1H_RETENTION_DAYS', 365)) * 86400,
+}
+# Насколько старую цену из истории можно показать, если кэш и источники пусты
+PRICE_HISTORY_FALLBACK_AGE = float(os.environ.get('PRICE_HISTORY_FALLBACK_AGE', 3600))
+
+# Сколько экран подписок ждет цены, прежде чем показать "Обновление данных..."
+SUBSCRIPTIONS_PRICE_DEADLINE = float(os.environ.get('SUBSCRIPTIONS_PRICE_DEADLINE', 3))
+
+# Сохранение context.user_data в базе (незавершенная настройка цели переживает перезапуск)
+PERSISTENCE_UPDATE_INTERVAL = float(os.environ.get('PERSISTENCE_UPDATE_INTERVAL', 30))
+# При старте загружаются только записи моложе этого срока, более старые удаляются
+PERSISTENCE_MAX_AGE = int(os.environ.get('PERSISTENCE_MAX_AGE', 86400))
+
+# Источники цен: здоровье, hedging и circuit breaker
+PROVIDER_HEALTH_WINDOW = int(os.environ.get('PROVIDER_HEALTH_WINDOW', 50))
+PROVIDER_HEDGE_PERCENTILE = float(os.environ.get('PROVIDER_HEDGE_PERCENTILE', 0.9))
+PROVIDER_HEDGE_DELAY = float(os.environ.get('PROVIDER_HEDGE_DELAY', 2))
+PROVIDER_FAILURE_THRESHOLD = int(os.environ.get('PROVIDER_FAILURE_THRESHOLD', 5))
+PROVIDER_CIRCUIT_RESET = float(os.environ.get('PROVIDER_CIRCUIT_RESET', 60))
+PROVIDER_ERROR_PENALTY = 10  # секунд задержки за 100% ошибок при ранжировании
+
+# Поток цен Binance (WebSocket)
+BINANCE_STREAM = os.environ.get('BINANCE_STREAM', '0') == '1'
+BINANCE_WS_URL = os.environ.get('BINANCE_WS_URL', 'wss://stream.binance.com:9443')
+BINANCE_WS_MAX_BACKOFF = float(os.environ.get('BINANCE_WS_MAX_BACKOFF', 60))
+
+# Отправка уведомлений (лимиты Telegram: ~30 сообщений/сек всего, ~1/сек в один чат)
+NOTIFY_WORKERS = int(os.environ.get('NOTIFY_WORKERS', 8))
+NOTIFY_QUEUE_SIZE = int(os.environ.get('NOTIFY_QUEUE_SIZE', 10000))
+NOTIFY_GLOBAL_RATE = float(os.environ.get('NOTIFY_GLOBAL_RATE', 30))
+NOTIFY_CHAT_RATE = float(os.environ.get('NOTIFY_CHAT_RATE', 1))
+NOTIFY_CHAT_BURST = int(os.environ.get('NOTIFY_CHAT_BURST', 3))
+NOTIFY_MAX_RETRIES = int(os.environ.get('NOTIFY_MAX_RETRIES', 3))
+NOTIFY_MAX_CHAT_BUCKETS = 10000
+NOTIFY_DRAIN_TIMEOUT = float(os.environ.get('NOTIFY_DRAIN_TIMEOUT', 30))
+# Алерт, не доставленный из-за временной ошибки, возвращается в проверку с нарастающей паузой,
+# после ALERT_MAX_ATTEMPTS таких попыток подписка отключается
+ALERT_MAX_ATTEMPTS = int(os.environ.get('ALERT_MAX_ATTEMPTS', 5))
+ALERT_RETRY_DELAY = float(os.environ.get('ALERT_RETRY_DELAY', 60))
+
+# Планировщик проверки цен (секунды)
+PRICE_CHECK_INTERVAL = float(os.environ.get('PRICE_CHECK_INTERVAL', 30))
+PRICE_CHECK_MIN_INTERVAL = float(os.environ.get('PRICE_CHECK_MIN_INTERVAL', 10))
+PRICE_CHECK_MAX_INTERVAL = float(os.environ.get('PRICE_CHECK_MAX_INTERVAL', 120))
+PRICE_CHECK_BUDGET = float(os.environ.get('PRICE_CHECK_BUDGET', 25))
+PRICE_CHECK_JITTER = 0.1
+# Изменение цены за тик (доля), при котором проверки ускоряются
+PRICE_CHECK_VOLATILITY = float(os.environ.get('PRICE_CHECK_VOLATILITY', 0.005))
+
+# HTTP пул соединений
+HTTP_POOL_LIMIT = int(os.environ.get('HTTP_POOL_LIMIT', 100))
+HTTP_POOL_LIMIT_PER_HOST = int(os.environ.get('HTTP_POOL_LIMIT_PER_HOST', 10))
+HTTP_KEEPALIVE_TIMEOUT = float(os.environ.get('HTTP_KEEPALIVE_TIMEOUT', 30))
+HTTP_DNS_CACHE_TTL = int(os.environ.get('HTTP_DNS_CACHE_TTL', 300))
+
+class PriceCache:
+    """Ограниченный кэш с LRU-вытеснением и собственным TTL для каждого ключа"""
+    
+    def __init__(self, max_size, default_ttl, stale_ttl=0):
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self.stale_ttl = stale_ttl
+        self._entries = OrderedDict()  # key -> (value, stored_at, ttl)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+    
+    def __contains__(self, key):
+        return key in self._entries
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, stored_at, ttl = entry
+        age = time.monotonic() - stored_at
+        if age >= ttl + self.stale_ttl:
+            # Запись устарела окончательно - удаляем
+            del self._entries[key]
+            self.expirations += 1
+            return None
+        return value, age, ttl
+    
+    def get(self, key, max_age=None):
+        """Свежее значение или None. max_age может только ужесточить TTL записи"""
+        found = self._lookup(key)
+        if found is None or found[1] >= min(found[2], max_age or found[2]):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return found[0]
+    
+    def get_stale(self, key):
+        """Значение, даже если TTL истек, но не старше stale_ttl сверх него"""
+        found = self._lookup(key)
+        if found is None:
+            return None
+        self._entries.move_to_end(key)
+        return found[0]
+    
+    def age(self, key):
+        """Возраст записи в секундах или None, если ее нет"""
+        found = self._lookup(key)
+        return found[1] if found else None
+    
+    def set(self, key, value, ttl=None):
+        self._entries[key] = (value, time.monotonic(), ttl if ttl is not None else self.default_ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+    
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0
+        }
+
+price_cache = PriceCache(PRICE_CACHE_MAX_SIZE, PRICE_CACHE_TTL, stale_ttl=CACHE_STALE_SECONDS)
+
+class AlertIndex:
+    """Индекс активных подписок: для каждой пары (crypto, currency) целевые цены
+    хранятся отсортированными, поэтому поиск сработавших занимает O(log n + k)
+    """
+    
     def __init__(self):
+        self._targets = {}     # (crypto, currency) -> отсортированный список (target_price, user_id)
+        self._by_user = {}     # user_id -> {(crypto, currency): target_price}
+    
+    def __len__(self):
+        return sum(len(targets) for targets in self._targets.values())
+    
+    def load(self, subscriptions):
+        self._targets.clear()
+        self._by_user.clear()
+        for user_id, crypto, currency, target_price in subscriptions:
+            self.add(user_id, crypto, currency, target_price)
+    
+    def add(self, user_id, crypto, currency, target_price):
+        self.remove(user_id, crypto, currency)
+        bisect.insort(self._targets.setdefault((crypto, currency), []), (target_price, user_id))
+        self._by_user.setdefault(user_id, {})[(crypto, currency)] = target_price
+    
+    def get(self, user_id, crypto, currency):
+        """Целевая цена подписки в индексе или None"""
+        return self._by_user.get(user_id, {}).get((crypto, currency))
+    
+    def remove(self, user_id, crypto, currency, target_price=None):
+        """Удаляет подписку из индекса (если задан target_price - только с этой целью).
+        False - ее там не было
+        """
+        user_pairs = self._by_user.get(user_id)
+        if not user_pairs or (crypto, currency) not in user_pairs:
+            return False
+        if target_price is not None and user_pairs[(crypto, currency)] != target_price:
+            return False
+        
+        target_price = user_pairs.pop((crypto, currency))
+        if not user_pairs:
+            del self._by_user[user_id]
+        
+        targets = self._targets[(crypto, currency)]
+        i = bisect.bisect_left(targets, (target_price, user_id))
+        if i < len(targets) and targets[i] == (target_price, user_id):
+            del targets[i]
+        if not targets:
+            del self._targets[(crypto, currency)]
+        return True
+    
+    def remove_user(self, user_id):
+        for crypto, currency in list(self._by_user.get(user_id, {})):
+            self.remove(user_id, crypto, currency)
+    
+    def pairs(self):
+        return list(self._targets)
+    
+    def has_pair(self, crypto, currency):
+        return (crypto, currency) in self._targets
+    
+    def triggered(self, crypto, currency, price):
+        """Подписки пары, у которых цель >= текущей цены: [(user_id, target_price), ...]"""
+        targets = self._targets.get((crypto, currency))
+        if not targets:
+            return []
+        i = bisect.bisect_left(targets, (price,))
+        return [(user_id, target_price) for target_price, user_id in targets[i:]]
+
+# Миграции схемы: (версия, описание, запросы). Текущая версия хранится в PRAGMA user_version
+MIGRATIONS = [
+    (1, "базовая схема", [
+        '''
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            user_id INTEGER,
+            crypto TEXT,
+            currency TEXT,
+            target_price REAL,
+            is_active INTEGER DEFAULT 1,
+            PRIMARY KEY (user_id, crypto, currency)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS user_settings (
+            user_id INTEGER PRIMARY KEY,
+            language TEXT DEFAULT 'ru'
+        )
+        ''',
+    ]),
+    (2, "индексы подписок", [
+        'CREATE INDEX IF NOT EXISTS idx_subscriptions_active ON subscriptions (crypto, currency) WHERE is_active = 1',
+    ]),
+    (3, "архив отключенных подписок", [
+        '''
+        CREATE TABLE IF NOT EXISTS subscriptions_archive (
+            user_id INTEGER,
+            crypto TEXT,
+            currency TEXT,
+            target_price REAL,
+            archived_at INTEGER
+        )
+        ''',
+        '''
+        INSERT INTO subscriptions_archive (user_id, crypto, currency, target_price, archived_at)
+        SELECT user_id, crypto, currency, target_price, CAST(strftime('%s', 'now') AS INTEGER)
+        FROM subscriptions WHERE is_active = 0
+        ''',
+        'DELETE FROM subscriptions WHERE is_active = 0',
+    ]),
+    (4, "файлы бота в Telegram", [
+        '''
+        CREATE TABLE IF NOT EXISTS bot_assets (
+            name TEXT PRIMARY KEY,
+            source TEXT,
+            file_id TEXT,
+            file_unique_id TEXT
+        )
+        ''',
+    ]),
+    (5, "кэш подписки на канал", [
+        '''
+        CREATE TABLE IF NOT EXISTS channel_members (
+            user_id INTEGER PRIMARY KEY,
+            is_member INTEGER,
+            checked_at INTEGER
+        )
+        ''',
+    ]),
+    (6, "пользователи", [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            updated_at INTEGER
+        )
+        ''',
+    ]),
+    (7, "история цен", [
+        '''
+        CREATE TABLE IF NOT EXISTS price_history (
+            crypto TEXT,
+            currency TEXT,
+            ts INTEGER,
+            price REAL,
+            PRIMARY KEY (crypto, currency, ts)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS price_candles (
+            crypto TEXT,
+            currency TEXT,
+            interval INTEGER,
+            start INTEGER,
+            open REAL,
+            high REAL,
+            low REAL,
+            close REAL,
+            PRIMARY KEY (crypto, currency, interval, start)
+        ) WITHOUT ROWID
+        ''',
+    ]),
+    (8, "данные пользователей из context.user_data", [
+        '''
+        CREATE TABLE IF NOT EXISTS user_data (
+            user_id INTEGER PRIMARY KEY,
+            data TEXT,
+            updated_at INTEGER
+        )
+        ''',
+    ]),
+]
+
+class Database:
+    def __init__(self, path=DB_PATH):
+        self.path = path
+        self._lock = threading.RLock()
+        self._read_lock = threading.Lock()
+        self.conn = self._connect()
         self.init_db()
+        # Отдельное соединение для чтения: в режиме WAL чтение не ждет записи
+        self.read_conn = self._connect()
+    
+    def _connect(self):
+        """Открывает единственное соединение с WAL-журналом"""
+        conn = sqlite3.connect(
+            self.path,
+            timeout=DB_BUSY_TIMEOUT,
+            check_same_thread=False,
+            cached_statements=DB_CACHED_STATEMENTS
+        )
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT * 1000)}')
+        logger.info(f"✅ Соединение с базой данных открыто: {self.path}")
+        return conn
+    
+    def _execute(self, query, params=()):
+        """Выполняет запрос на изменение в транзакции с повтором при блокировке"""
+        return self._transaction([(query, params)])
+    
+    def _transaction(self, statements):
+        """Выполняет несколько запросов в одной транзакции с повтором при блокировке"""
+        for attempt in range(DB_LOCK_RETRIES + 1):
+            try:
+                with self._lock, self.conn:
+                    self.conn.execute('BEGIN')
+                    cursor = None
+                    for query, params in statements:
+                        cursor = self.conn.execute(query, params)
+                    return cursor
+            except sqlite3.OperationalError as e:
+                if 'locked' not in str(e) or attempt == DB_LOCK_RETRIES:
+                    raise
+                logger.warning(f"⚠️ База данных занята, повтор {attempt + 1}/{DB_LOCK_RETRIES}")
+                time.sleep(0.1 * (attempt + 1))
+    
+    def _fetchone(self, query, params=()):
+        with self._read_lock:
+            return self.read_conn.execute(query, params).fetchone()
+    
+    def _fetchall(self, query, params=()):
+        with self._read_lock:
+            return self.read_conn.execute(query, params).fetchall()
+    
+    def close(self):
+        with self._read_lock:
+            self.read_conn.close()
+        with self._lock:
+            self.conn.close()
+        logger.info("✅ Соединение с базой данных закрыто")
     
     def init_db(self):
-        with sqlite3.connect('crypto_bot.db', check_same_thread=False) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS subscriptions (
-                    user_id INTEGER,
-                    crypto TEXT,
-                    currency TEXT,
-                    target_price REAL,
-                    is_active INTEGER DEFAULT 1,
-                    PRIMARY KEY (user_id, crypto, currency)
-                )
-            ''')
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS user_settings (
-                    user_id INTEGER PRIMARY KEY,
-                    language TEXT DEFAULT 'ru'
-                )
-            ''')
-            conn.commit()
-        logger.info("✅ База данных инициализирована")
+        with self._lock:
+            current_version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+            
+            for version, description, queries in MIGRATIONS:
+                if version <= current_version:
+                    continue
+                # Каждая миграция применяется атомарно вместе с новой версией схемы
+                with self.conn:
+                    self.conn.execute('BEGIN')
+                    for query in queries:
+                        self.conn.execute(query)
+                    self.conn.execute(f'PRAGMA user_version = {version}')
+                logger.info(f"✅ Миграция {version} применена: {description}")
+                current_version = version
+        
+        logger.info(f"✅ База данных инициализирована (версия схемы {current_version})")
     
     def get_user_language(self, user_id):
-        try:
-            with sqlite3.connect('crypto_bot.db', check_same_thread=False) as conn:
-                cursor = conn.cursor()
-                cursor.execute('SELECT language FROM user_settings WHERE user_id = ?', (user_id,))
-                result = cursor.fetchone()
-                return result[0] if result else 'ru'
-        except Exception as e:
-            logger.error(f"❌ Ошибка получения языка: {e}")
-            return 'ru'
+        result = self._fetchone('SELECT language FROM user_settings WHERE user_id = ?', (user_id,))
+        return result[0] if result else 'ru'
+    
+    def get_user_languages(self, limit):
+        return self._fetchall('SELECT user_id, language FROM user_settings LIMIT ?', (limit,))
     
     def set_user_language(self, user_id, language):
         try:
-            with sqlite3.connect('crypto_bot.db', check_same_thread=False) as conn:
-                cursor = conn.cursor()
-                cursor.execute('INSERT OR REPLACE INTO user_settings (user_id, language) VALUES (?, ?)', 
-                             (user_id, language))
-                conn.commit()
+            self._execute('INSERT OR REPLACE INTO user_settings (user_id, language) VALUES (?, ?)',
+                          (user_id, language))
             logger.info(f"✅ Язык сохранен: {user_id} -> {language}")
             return True
         except Exception as e:
@@ -99,14 +510,11 @@ class Database:
     
     def save_subscription(self, user_id, crypto, currency, target_price):
         try:
-            with sqlite3.connect('crypto_bot.db', check_same_thread=False) as conn:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    INSERT OR REPLACE INTO subscriptions 
-                    (user_id, crypto, currency, target_price, is_active) 
-                    VALUES (?, ?, ?, ?, 1)
-                ''', (user_id, crypto, currency, target_price))
-                conn.commit()
+            self._execute('''
+                INSERT OR REPLACE INTO subscriptions 
+                (user_id, crypto, currency, target_price, is_active) 
+                VALUES (?, ?, ?, ?, 1)
+            ''', (user_id, crypto, currency, target_price))
             logger.info(f"✅ Подписка сохранена: {user_id}, {crypto}, {currency}, {target_price}")
             return True
         except Exception as e:
@@ -115,177 +523,1412 @@ class Database:
     
     def get_user_subscriptions(self, user_id):
         try:
-            with sqlite3.connect('crypto_bot.db', check_same_thread=False) as conn:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    SELECT crypto, currency, target_price 
-                    FROM subscriptions 
-                    WHERE user_id = ? AND is_active = 1
-                ''', (user_id,))
-                result = cursor.fetchall()
-                logger.info(f"✅ Найдено подписок для {user_id}: {len(result)}")
-                return result
+            result = self._fetchall('''
+                SELECT crypto, currency, target_price 
+                FROM subscriptions 
+                WHERE user_id = ? AND is_active = 1
+            ''', (user_id,))
+            logger.info(f"✅ Найдено подписок для {user_id}: {len(result)}")
+            return result
         except Exception as e:
             logger.error(f"❌ Ошибка получения подписок: {e}")
             return []
     
+    def get_active_subscriptions(self):
+        return self._fetchall(
+            'SELECT user_id, crypto, currency, target_price FROM subscriptions WHERE is_active = 1'
+        )
+    
+    def _archive_subscriptions(self, condition, params):
+        """Переносит подписки в архив, чтобы в subscriptions оставались только активные"""
+        self._transaction([
+            (f'''
+                INSERT INTO subscriptions_archive (user_id, crypto, currency, target_price, archived_at)
+                SELECT user_id, crypto, currency, target_price, ?
+                FROM subscriptions WHERE {condition}
+            ''', (int(time.time()), *params)),
+            (f'DELETE FROM subscriptions WHERE {condition}', params),
+        ])
+    
     def stop_all_subscriptions(self, user_id):
-        with sqlite3.connect('crypto_bot.db', check_same_thread=False) as conn:
-            cursor = conn.cursor()
-            cursor.execute('UPDATE subscriptions SET is_active = 0 WHERE user_id = ?', (user_id,))
-            conn.commit()
-    
-    def deactivate_subscription(self, user_id, crypto, currency):
-        with sqlite3.connect('crypto_bot.db', check_same_thread=False) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                UPDATE subscriptions SET is_active = 0 
-                WHERE user_id = ? AND crypto = ? AND currency = ?
-            ''', (user_id, crypto, currency))
-            conn.commit()
+        self._archive_subscriptions('user_id = ?', (user_id,))
+    
+    def deactivate_subscription(self, user_id, crypto, currency, target_price):
+        # Цель сверяется: если пользователь успел задать новую, она остается активной
+        self._archive_subscriptions('user_id = ? AND crypto = ? AND currency = ? AND target_price = ?',
+                                    (user_id, crypto, currency, target_price))
+    
+    def get_asset(self, name):
+        """Возвращает (source, file_id, file_unique_id) загруженного в Telegram файла"""
+        return self._fetchone('SELECT source, file_id, file_unique_id FROM bot_assets WHERE name = ?', (name,))
+    
+    def set_asset(self, name, source, file_id, file_unique_id):
+        try:
+            self._execute('INSERT OR REPLACE INTO bot_assets (name, source, file_id, file_unique_id) VALUES (?, ?, ?, ?)',
+                          (name, source, file_id, file_unique_id))
+            return True
+        except Exception as e:
+            logger.error(f"❌ Ошибка сохранения file_id: {e}")
+            return False
+    
+    def get_membership(self, user_id):
+        """Возвращает (is_member, checked_at) последней проверки подписки на канал"""
+        return self._fetchone('SELECT is_member, checked_at FROM channel_members WHERE user_id = ?', (user_id,))
+    
+    def set_membership(self, user_id, is_member, checked_at):
+        try:
+            self._execute('INSERT OR REPLACE INTO channel_members (user_id, is_member, checked_at) VALUES (?, ?, ?)',
+                          (user_id, int(is_member), checked_at))
+            return True
+        except Exception as e:
+            logger.error(f"❌ Ошибка сохранения подписки на канал: {e}")
+            return False
+    
+    def save_price_history(self, samples, candles):
+        """Пишет пачку точек (crypto, currency, ts, price) и свечей одной транзакцией.
+        
+        Свеча (crypto, currency, interval, start, open, high, low, close) сливается
+        с уже записанной за тот же интервал.
+        """
+        sample_query = 'INSERT OR REPLACE INTO price_history (crypto, currency, ts, price) VALUES (?, ?, ?, ?)'
+        candle_query = '''
+            INSERT INTO price_candles (crypto, currency, interval, start, open, high, low, close)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (crypto, currency, interval, start) DO UPDATE SET
+                high = max(high, excluded.high),
+                low = min(low, excluded.low),
+                close = excluded.close
+        '''
+        self._transaction([(sample_query, sample) for sample in samples] +
+                          [(candle_query, candle) for candle in candles])
+    
+    def get_price_history_pairs(self):
+        """Пары, по которым есть свечи. Идет по первичному ключу от пары к паре, не читая таблицу целиком"""
+        pairs = []
+        row = self._fetchone('SELECT crypto, currency FROM price_candles ORDER BY crypto, currency LIMIT 1')
+        while row:
+            pairs.append(tuple(row))
+            row = self._fetchone('''
+                SELECT crypto, currency FROM price_candles
+                WHERE (crypto, currency) > (?, ?)
+                ORDER BY crypto, currency LIMIT 1
+            ''', tuple(row))
+        return pairs
+    
+    def prune_price_history(self, crypto, currency, raw_before, candles_before):
+        """Удаляет старые точки и свечи одной пары (candles_before: интервал -> граница)"""
+        statements = [('DELETE FROM price_history WHERE crypto = ? AND currency = ? AND ts < ?',
+                       (crypto, currency, raw_before))]
+        for interval, before in candles_before.items():
+            statements.append(('DELETE FROM price_candles WHERE crypto = ? AND currency = ? AND interval = ? AND start < ?',
+                               (crypto, currency, interval, before)))
+        self._transaction(statements)
+    
+    def get_candles(self, crypto, currency, interval, since):
+        return self._fetchall('''
+            SELECT start, open, high, low, close FROM price_candles
+            WHERE crypto = ? AND currency = ? AND interval = ? AND start >= ?
+            ORDER BY start
+        ''', (crypto, currency, interval, since))
+    
+    def get_last_price(self, crypto, currency):
+        return self._fetchone('''
+            SELECT ts, price FROM price_history
+            WHERE crypto = ? AND currency = ?
+            ORDER BY ts DESC LIMIT 1
+        ''', (crypto, currency))
+    
+    def get_user_data(self, user_id, since):
+        result = self._fetchone('SELECT data FROM user_data WHERE user_id = ? AND updated_at >= ?', (user_id, since))
+        return result[0] if result else None
+    
+    def save_user_data(self, items):
+        """Пишет пачку (user_id, data) одной транзакцией; data=None удаляет запись"""
+        now = int(time.time())
+        self._transaction([
+            ('DELETE FROM user_data WHERE user_id = ?', (user_id,)) if data is None else
+            ('INSERT OR REPLACE INTO user_data (user_id, data, updated_at) VALUES (?, ?, ?)', (user_id, data, now))
+            for user_id, data in items
+        ])
+    
+    def prune_user_data(self, before_ts):
+        self._execute('DELETE FROM user_data WHERE updated_at < ?', (before_ts,))
+    
+    def get_username(self, user_id):
+        result = self._fetchone('SELECT username FROM users WHERE user_id = ?', (user_id,))
+        return result[0] if result else None
+    
+    def save_user(self, user_id, username):
+        try:
+            self._execute('INSERT OR REPLACE INTO users (user_id, username, updated_at) VALUES (?, ?, ?)',
+                          (user_id, username, int(time.time())))
+            return True
+        except Exception as e:
+            logger.error(f"❌ Ошибка сохранения пользователя: {e}")
+            return False
 
-class PriceService:
+class AsyncDatabase:
+    """Асинхронный доступ к Database без блокировки event loop.
+    
+    Чтение выполняется в отдельном потоке, запись - через очередь,
+    которую последовательно разбирает единственный поток записи.
+    """
+    
+    def __init__(self, db):
+        self.db = db
+        self._read_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-read')
+        self._write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-write')
+        self._write_queue = None
+        self._writer_task = None
+        self._language_cache = OrderedDict()  # user_id -> язык, в порядке последнего обращения
+        self._membership_cache = PriceCache(MEMBERSHIP_CACHE_SIZE, MEMBERSHIP_POSITIVE_TTL)
+        self._username_cache = OrderedDict()  # user_id -> username ('' если его нет)
+        self.alert_index = AlertIndex()
+        self._alert_retries = {}  # (user_id, crypto, currency) -> (target_price, число неудачных попыток)
+    
+    async def start(self):
+        if self._writer_task and not self._writer_task.done():
+            return
+        self._write_queue = asyncio.Queue()
+        self._writer_task = asyncio.create_task(self._writer_loop())
+    
+    async def _writer_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            func, args, future = await self._write_queue.get()
+            try:
+                result = await loop.run_in_executor(self._write_executor, func, *args)
+                if not future.done():
+                    future.set_result(result)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                self._write_queue.task_done()
+    
+    async def _read(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._read_executor, func, *args)
+    
+    async def _write(self, func, *args):
+        await self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._write_queue.put((func, args, future))
+        return await future
+    
+    async def flush(self):
+        """Дожидается выполнения всех поставленных в очередь записей"""
+        if self._write_queue is not None:
+            await self._write_queue.join()
+    
+    async def stop(self):
+        """Дописывает очередь и останавливает задачу записи (потоки остаются для перезапуска)"""
+        await self.flush()
+        if self._writer_task:
+            self._writer_task.cancel()
+            await asyncio.gather(self._writer_task, return_exceptions=True)
+            self._writer_task = None
+        self._write_queue = None
+    
+    async def close(self):
+        await self.stop()
+        self._read_executor.shutdown(wait=True)
+        self._write_executor.shutdown(wait=True)
+        self.db.close()
+    
+    def _remember_language(self, user_id, language):
+        # Коды языков интернируются, чтобы все записи ссылались на одни и те же строки
+        self._language_cache[user_id] = sys.intern(language)
+        self._language_cache.move_to_end(user_id)
+        while len(self._language_cache) > LANGUAGE_CACHE_SIZE:
+            self._language_cache.popitem(last=False)
+    
+    async def preload_languages(self):
+        """Загружает языки пользователей в кэш при старте"""
+        rows = await self._read(self.db.get_user_languages, LANGUAGE_CACHE_SIZE)
+        for user_id, language in rows:
+            self._remember_language(user_id, language)
+        logger.info(f"✅ Загружено языков пользователей в кэш: {len(rows)}")
+    
+    async def get_user_language(self, user_id):
+        language = self._language_cache.get(user_id)
+        if language is not None:
+            self._language_cache.move_to_end(user_id)
+            return language
+        
+        try:
+            language = await self._read(self.db.get_user_language, user_id)
+        except Exception as e:
+            # Запасной язык не кэшируем, иначе временная ошибка закрепит его до вытеснения
+            logger.error(f"❌ Ошибка получения языка: {e}")
+            return 'ru'
+        self._remember_language(user_id, language)
+        return language
+    
+    def _remember_username(self, user_id, username):
+        self._username_cache[user_id] = username
+        self._username_cache.move_to_end(user_id)
+        while len(self._username_cache) > USER_CACHE_SIZE:
+            self._username_cache.popitem(last=False)
+    
+    async def remember_user(self, user):
+        """Сохраняет username из входящего обновления; в базу пишет только изменения"""
+        if user is None:
+            return
+        username = user.username or ''
+        if self._username_cache.get(user.id) == username:
+            self._username_cache.move_to_end(user.id)
+            return
+        self._remember_username(user.id, username)
+        await self._write(self.db.save_user, user.id, username)
+    
+    async def save_price_history(self, samples, candles):
+        await self._write(self.db.save_price_history, samples, candles)
+    
+    async def get_price_history_pairs(self):
+        return await self._read(self.db.get_price_history_pairs)
+    
+    async def prune_price_history(self, crypto, currency, raw_before, candles_before):
+        await self._write(self.db.prune_price_history, crypto, currency, raw_before, candles_before)
+    
+    async def get_candles(self, crypto, currency, interval, since):
+        return await self._read(self.db.get_candles, crypto, currency, interval, since)
+    
+    async def get_last_price(self, crypto, currency):
+        return await self._read(self.db.get_last_price, crypto, currency)
+    
+    async def get_user_data(self, user_id, since):
+        return await self._read(self.db.get_user_data, user_id, since)
+    
+    async def save_user_data(self, items):
+        await self._write(self.db.save_user_data, items)
+    
+    async def prune_user_data(self, before_ts):
+        await self._write(self.db.prune_user_data, before_ts)
+    
+    async def get_username(self, user_id):
+        """username пользователя без обращения к Bot API; None, если он неизвестен"""
+        username = self._username_cache.get(user_id)
+        if username is None:
+            username = await self._read(self.db.get_username, user_id)
+            if username is None:
+                return None
+            self._remember_username(user_id, username)
+        else:
+            self._username_cache.move_to_end(user_id)
+        return username or None
+    
+    async def set_user_language(self, user_id, language):
+        success = await self._write(self.db.set_user_language, user_id, language)
+        if success:
+            self._remember_language(user_id, language)
+        return success
+    
+    async def load_alert_index(self):
+        """Строит индекс алертов по активным подпискам"""
+        subscriptions = await self._read(self.db.get_active_subscriptions)
+        self.alert_index.load(subscriptions)
+        self._alert_retries.clear()
+        logger.info(f"✅ Индекс алертов загружен: {len(subscriptions)} подписок")
+    
+    async def save_subscription(self, user_id, crypto, currency, target_price):
+        success = await self._write(self.db.save_subscription, user_id, crypto, currency, target_price)
+        if success:
+            self.alert_index.add(user_id, crypto, currency, target_price)
+            self._alert_retries.pop((user_id, crypto, currency), None)
+        return success
+    
+    async def get_user_subscriptions(self, user_id):
+        return await self._read(self.db.get_user_subscriptions, user_id)
+    
+    async def get_active_subscriptions(self):
+        return await self._read(self.db.get_active_subscriptions)
+    
+    async def stop_all_subscriptions(self, user_id):
+        await self._write(self.db.stop_all_subscriptions, user_id)
+        self.alert_index.remove_user(user_id)
+        for key in [key for key in self._alert_retries if key[0] == user_id]:
+            del self._alert_retries[key]
+    
+    async def deactivate_subscription(self, user_id, crypto, currency, target_price):
+        await self._write(self.db.deactivate_subscription, user_id, crypto, currency, target_price)
+        self.alert_index.remove(user_id, crypto, currency, target_price)
+        if self._alert_retries.get((user_id, crypto, currency), (None,))[0] == target_price:
+            del self._alert_retries[(user_id, crypto, currency)]
+    
+    def restore_alert(self, user_id, crypto, currency, target_price):
+        """Возвращает неотправленный алерт в индекс, если для пары не задана новая цель"""
+        if self.alert_index.get(user_id, crypto, currency) is None:
+            self.alert_index.add(user_id, crypto, currency, target_price)
+    
+    def retry_alert(self, user_id, crypto, currency, target_price):
+        """Возвращает алерт в индекс после временной ошибки доставки.
+        
+        Пауза удваивается с каждой попыткой. False - попытки исчерпаны.
+        """
+        key = (user_id, crypto, currency)
+        retry = self._alert_retries.get(key)
+        attempt = retry[1] + 1 if retry and retry[0] == target_price else 1
+        if attempt >= ALERT_MAX_ATTEMPTS:
+            self._alert_retries.pop(key, None)
+            return False
+        self._alert_retries[key] = (target_price, attempt)
+        
+        def restore():
+            # За время паузы пользователь мог задать новую цель или отключить подписки
+            if self._alert_retries.get(key, (None,))[0] == target_price:
+                self.restore_alert(user_id, crypto, currency, target_price)
+        
+        asyncio.get_running_loop().call_later(ALERT_RETRY_DELAY * 2 ** (attempt - 1), restore)
+        return True
+    
+    async def get_asset(self, name):
+        return await self._read(self.db.get_asset, name)
+    
+    async def set_asset(self, name, source, file_id, file_unique_id):
+        return await self._write(self.db.set_asset, name, source, file_id, file_unique_id)
+    
+    async def get_membership(self, user_id):
+        """Результат проверки подписки на канал, если он еще не истек, иначе None"""
+        is_member = self._membership_cache.get(user_id)
+        if is_member is not None:
+            return is_member
+        
+        row = await self._read(self.db.get_membership, user_id)
+        if row is None:
+            return None
+        is_member, checked_at = bool(row[0]), row[1]
+        ttl = (MEMBERSHIP_POSITIVE_TTL if is_member else MEMBERSHIP_NEGATIVE_TTL) - (time.time() - checked_at)
+        if ttl <= 0:
+            return None
+        self._membership_cache.set(user_id, is_member, ttl)
+        return is_member
+    
+    async def set_membership(self, user_id, is_member):
+        ttl = MEMBERSHIP_POSITIVE_TTL if is_member else MEMBERSHIP_NEGATIVE_TTL
+        self._membership_cache.set(user_id, is_member, ttl)
+        return await self._write(self.db.set_membership, user_id, is_member, int(time.time()))
+
+class SQLitePersistence(BasePersistence):
+    """Хранит context.user_data в таблице user_data.
+    
+    Application сообщает об изменениях раз в update_interval секунд; все измененные
+    за этот цикл записи уходят в базу одной транзакцией. При старте ничего не загружается:
+    запись пользователя (не старше PERSISTENCE_MAX_AGE) читается при первом его обновлении.
+    Данные хранятся в JSON.
+    """
+    
+    def __init__(self, db, update_interval=PERSISTENCE_UPDATE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.db = db
+        self._stored = {}  # user_id -> JSON, который сейчас лежит в базе
+        self._loaded = set()  # пользователи, чья запись уже прочитана из базы
+        self._pending = {}  # user_id -> JSON или None для удаления
+        self._write_task = None
+    
+    async def get_user_data(self):
+        # Устаревшие записи удаляем, остальные загружаются лениво в refresh_user_data
+        await self.db.prune_user_data(int(time.time() - PERSISTENCE_MAX_AGE))
+        return {}
+    
+    async def refresh_user_data(self, user_id, user_data):
+        """Вызывается Application перед каждым обновлением пользователя"""
+        if user_id in self._loaded:
+            return
+        self._loaded.add(user_id)
+        data = await self.db.get_user_data(user_id, int(time.time() - PERSISTENCE_MAX_AGE))
+        if data is None:
+            return
+        self._stored[user_id] = data
+        if not user_data:
+            user_data.update(json.loads(data))
+    
+    async def update_user_data(self, user_id, data):
+        # Application отмечает каждого активного пользователя - пишем только реальные изменения
+        data = json.dumps(data, ensure_ascii=False) if data else None
+        if self._stored.get(user_id) == data:
+            return
+        if data is None:
+            self._stored.pop(user_id, None)
+        else:
+            self._stored[user_id] = data
+        self._pending[user_id] = data
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.ensure_future(self._write_pending())
+    
+    async def drop_user_data(self, user_id):
+        await self.update_user_data(user_id, None)
+    
+    async def _write_pending(self):
+        # Даем Application передать все изменения текущего цикла, затем пишем их разом
+        await asyncio.sleep(0)
+        items, self._pending = list(self._pending.items()), {}
+        if items:
+            try:
+                await self.db.save_user_data(items)
+            except Exception as e:
+                logger.error(f"❌ Ошибка сохранения данных пользователей: {e}")
+    
+    async def flush(self):
+        if self._write_task:
+            await self._write_task
+        await self._write_pending()
+    
+    # Остальные данные не сохраняются
+    async def get_chat_data(self):
+        return {}
+    
+    async def get_bot_data(self):
+        return {}
+    
+    async def get_callback_data(self):
+        return None
+    
+    async def get_conversations(self, name):
+        return {}
+    
+    async def update_conversation(self, name, key, new_state):
+        pass
+    
+    async def update_chat_data(self, chat_id, data):
+        pass
+    
+    async def update_bot_data(self, data):
+        pass
+    
+    async def update_callback_data(self, data):
+        pass
+    
+    async def drop_chat_data(self, chat_id):
+        pass
+    
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+    
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+class PriceProvider:
+    """Базовый источник данных. Сетевые ошибки пробрасываются наружу,
+    чтобы ProviderRegistry учитывал их в здоровье источника
+    """
+    
+    name = None
+    
+    def __init__(self, price_service):
+        self.price_service = price_service
+    
+    async def _get_json(self, url, timeout, params=None):
+        session = await self.price_service._get_session()
+        async with session.get(url, params=params, timeout=timeout) as response:
+            response.raise_for_status()
+            return await response.json()
+
+class CoinGeckoProvider(PriceProvider):
+    name = "coingecko"
+    
+    async def fetch_prices(self):
+        """Цены всех CRYPTO_CURRENCIES во всех TARGET_CURRENCIES одним запросом"""
+        ids = ",".join(CRYPTO_CURRENCIES.values())
+        vs_currencies = ",".join(TARGET_CURRENCIES.values())
+        data = await self._get_json(
+            f"https://api.coingecko.com/api/v3/simple/price?ids={ids}&vs_currencies={vs_currencies}",
+            timeout=10
+        )
+        
+        prices = {}
+        for crypto, currency_id in CRYPTO_CURRENCIES.items():
+            for target_currency, price in data.get(currency_id, {}).items():
+                prices[(crypto, target_currency)] = price
+        return prices
+
+class BinanceProvider(PriceProvider):
+    name = "binance"
+    
+    async def fetch_prices(self):
+        """Цены всех BINANCE_SYMBOLS одним запросом с пересчетом из USD"""
+        symbols = json.dumps(list(BINANCE_SYMBOLS.values()), separators=(',', ':'))
+        data = await self._get_json(
+            "https://api.binance.com/api/v3/ticker/price",
+            timeout=10,
+            params={'symbols': symbols}
+        )
+        
+        cryptos = {symbol: crypto for crypto, symbol in BINANCE_SYMBOLS.items()}
+        multipliers = await self.price_service.get_usd_multipliers()
+        prices = {}
+        for ticker in data:
+            crypto = cryptos.get(ticker['symbol'])
+            if not crypto:
+                continue
+            usd_price = float(ticker['price'])
+            for target_currency, rate in multipliers.items():
+                prices[(crypto, target_currency)] = usd_price * rate
+        return prices
+
+class ExchangeRateApiProvider(PriceProvider):
+    name = "exchangerate-api"
+    
+    async def fetch_rates(self):
+        """Курсы валют к USD: {"rub": 95.1, ...}"""
+        data = await self._get_json("https://api.exchangerate-api.com/v4/latest/USD", timeout=5)
+        return {currency.lower(): float(rate) for currency, rate in data.get('rates', {}).items()}
+
+class CoinGeckoFxProvider(PriceProvider):
+    name = "coingecko-fx"
+    
+    async def fetch_rates(self):
+        """Курсы валют к USD по цене USDT на CoinGecko"""
+        vs_currencies = ",".join(TARGET_CURRENCIES.values())
+        data = await self._get_json(
+            f"https://api.coingecko.com/api/v3/simple/price?ids=tether&vs_currencies={vs_currencies}",
+            timeout=5
+        )
+        usdt = data.get('tether', {})
+        if not usdt.get('usd'):
+            return {}
+        return {currency: float(price) / usdt['usd'] for currency, price in usdt.items()}
+
+class ProviderHealth:
+    """Задержки и ошибки источника за последние запросы и его circuit breaker"""
+    
     def __init__(self):
-        self.db = Database()
+        self.latencies = deque(maxlen=PROVIDER_HEALTH_WINDOW)
+        self.results = deque(maxlen=PROVIDER_HEALTH_WINDOW)
+        self.consecutive_failures = 0
+        self.state = 'closed'
+        self.opened_at = None
+    
+    def record_success(self, latency):
+        self.latencies.append(latency)
+        self.results.append(True)
+        self.consecutive_failures = 0
+        self.state = 'closed'
+    
+    def record_latency(self, latency):
+        """Задержка без исхода: запрос отменен, ответ пришел бы не раньше latency"""
+        self.latencies.append(latency)
+    
+    def record_failure(self, latency):
+        self.latencies.append(latency)
+        self.results.append(False)
+        self.consecutive_failures += 1
+        if self.state == 'half_open' or self.consecutive_failures >= PROVIDER_FAILURE_THRESHOLD:
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+    
+    def is_available(self):
+        if self.state == 'open':
+            # После паузы пропускаем один пробный запрос
+            return time.monotonic() - self.opened_at >= PROVIDER_CIRCUIT_RESET
+        return self.state == 'closed'
+    
+    def latency_percentile(self, percentile, min_samples=5):
+        if len(self.latencies) < min_samples:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(int(len(ordered) * percentile), len(ordered) - 1)]
+    
+    def error_rate(self):
+        if not self.results:
+            return 0.0
+        return self.results.count(False) / len(self.results)
     
-    async def get_usd_to_rub_rate(self):
-        cache_key = "usd_rub"
-        if self._is_cache_valid(cache_key):
-            return price_cache[cache_key]['price']
+    def score(self):
+        """Чем меньше, тем лучше: медианная задержка плюс штраф за долю ошибок.
         
+        Пока замеров нет, задержка считается равной PROVIDER_HEDGE_DELAY.
+        """
+        median = self.latency_percentile(0.5, min_samples=1)
+        if median is None:
+            median = PROVIDER_HEDGE_DELAY
+        return median + PROVIDER_ERROR_PENALTY * self.error_rate()
+
+class ProviderRegistry:
+    """Выбирает самый здоровый источник, страхует медленные запросы
+    вторым запросом (hedging) и переключается на следующий при ошибке
+    """
+    
+    def __init__(self, providers):
+        self.providers = providers
+        self.health = {provider.name: ProviderHealth() for provider in providers}
+        self.hedges = 0
+    
+    def ranked(self, exclude=()):
+        available = [
+            provider for provider in self.providers
+            if provider.name not in exclude and self.health[provider.name].is_available()
+        ]
+        # sorted стабилен: при равных оценках сохраняется порядок регистрации
+        return sorted(available, key=lambda provider: self.health[provider.name].score())
+    
+    def _hedge_delay(self, provider):
+        delay = self.health[provider.name].latency_percentile(PROVIDER_HEDGE_PERCENTILE)
+        return delay if delay is not None else PROVIDER_HEDGE_DELAY
+    
+    async def _timed_call(self, provider, method):
+        health = self.health[provider.name]
+        if health.state == 'open':
+            health.state = 'half_open'
+        started = time.monotonic()
         try:
-            async with aiohttp.ClientSession() as session:
-                sources = [
-                    "https://api.exchangerate-api.com/v4/latest/USD",
-                    "https://api.coingecko.com/api/v3/simple/price?ids=usd&vs_currencies=rub",
-                ]
+            result = await getattr(provider, method)()
+        except asyncio.CancelledError:
+            # Проигравший hedged-запрос: он медленнее победителя, учитываем хотя бы
+            # прошедшее время, иначе медленный источник навсегда останется первым
+            health.record_latency(time.monotonic() - started)
+            # Пробный запрос не состоялся, повторим его позже
+            if health.state == 'half_open':
+                health.state = 'open'
+            raise
+        except Exception as e:
+            health.record_failure(time.monotonic() - started)
+            logger.error(f"❌ {provider.name}: ошибка {method}: {e}")
+            if health.state == 'open':
+                logger.warning(f"⚠️ Circuit breaker {provider.name} открыт")
+            return None
+        if health.state == 'half_open':
+            logger.info(f"✅ Circuit breaker {provider.name} закрыт")
+        health.record_success(time.monotonic() - started)
+        return result
+    
+    async def call(self, method, exclude=()):
+        """Возвращает (имя источника, результат) первого непустого ответа или (None, None)"""
+        candidates = self.ranked(exclude)
+        pending = {}
+        last_launched = None
+        
+        def launch():
+            nonlocal last_launched
+            last_launched = candidates.pop(0)
+            pending[asyncio.ensure_future(self._timed_call(last_launched, method))] = last_launched
+        
+        if candidates:
+            launch()
+        try:
+            while pending:
+                timeout = self._hedge_delay(last_launched) if candidates else None
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
                 
-                for url in sources:
-                    try:
-                        async with session.get(url, timeout=5) as response:
-                            if response.status == 200:
-                                data = await response.json()
-                                rate = self._parse_exchange_rate(data)
-                                if rate:
-                                    self._set_cache(cache_key, rate)
-                                    logger.info(f"💰 Курс USD/RUB: {rate}")
-                                    return rate
-                    except:
-                        continue
+                if not done:
+                    # Ответ медленнее обычного - страхуем запросом к следующему источнику
+                    self.hedges += 1
+                    logger.info(f"🔀 {last_launched.name} отвечает медленно, дублируем запрос")
+                    launch()
+                    continue
                 
-                rate = 95.0
-                self._set_cache(cache_key, rate)
-                return rate
+                for task in done:
+                    provider = pending.pop(task)
+                    result = task.result()
+                    if result:
+                        return provider.name, result
                 
+                if candidates and not pending:
+                    launch()
+        finally:
+            for task in pending:
+                task.cancel()
+        
+        return None, None
+    
+    def get_stats(self):
+        stats = {'hedges': self.hedges}
+        for name, health in self.health.items():
+            p50 = health.latency_percentile(0.5)
+            stats[name] = {
+                'state': health.state,
+                'error_rate': round(health.error_rate(), 3),
+                'p50': round(p50, 3) if p50 is not None else None
+            }
+        return stats
+
+class PriceHistory:
+    """История цен: точки копятся в памяти и пачками пишутся в price_history,
+    одновременно сворачиваясь в свечи price_candles по интервалам PRICE_CANDLE_RETENTION.
+    
+    Сырые точки хранятся PRICE_HISTORY_RAW_RETENTION, свечи - дольше, у каждого интервала свой срок.
+    Валюта хранится в нижнем регистре, как в ключах кэша цен.
+    """
+    
+    def __init__(self, db):
+        self.db = db
+        self._buffer = deque(maxlen=PRICE_HISTORY_BUFFER_SIZE)  # (crypto, currency, ts, price)
+        self._last = {}  # (crypto, currency) -> (ts, price) последней записанной точки
+        self._last_prune = 0
+    
+    def record(self, crypto, currency, price, ts=None):
+        """Добавляет точку, если с прошлой по этой паре прошло не меньше PRICE_HISTORY_STEP"""
+        ts = int(ts if ts is not None else time.time())
+        key = (crypto, currency.lower())
+        last = self._last.get(key)
+        if last and ts - last[0] < PRICE_HISTORY_STEP:
+            return
+        self._last[key] = (ts, price)
+        self._buffer.append((crypto, key[1], ts, price))
+    
+    @staticmethod
+    def _to_candles(samples, interval):
+        """Сворачивает точки (crypto, currency, ts, price) в свечи; у каждой пары точки идут по времени"""
+        candles = {}
+        for crypto, currency, ts, price in samples:
+            start = ts - ts % interval
+            key = (crypto, currency, interval, start)
+            candle = candles.get(key)
+            if candle:
+                candles[key] = (candle[0], max(candle[1], price), min(candle[2], price), price)
+            else:
+                candles[key] = (price, price, price, price)
+        return [key + candle for key, candle in candles.items()]
+    
+    async def flush(self):
+        """Сбрасывает накопленные точки и свечи в базу и раз в час удаляет старую историю"""
+        if self._buffer:
+            samples = list(self._buffer)
+            self._buffer.clear()
+            candles = []
+            for interval in PRICE_CANDLE_RETENTION:
+                candles += self._to_candles(samples, interval)
+            await self.db.save_price_history(samples, candles)
+            logger.info(f"✅ История цен: записано {len(samples)} точек, {len(candles)} свечей")
+        
+        now = time.time()
+        if now - self._last_prune >= 3600:
+            self._last_prune = now
+            await self.prune(now)
+    
+    async def prune(self, now):
+        """Удаляет старую историю по одной паре: каждое удаление - короткая запись
+        по префиксу первичного ключа, и записи пользователей не ждут общей чистки
+        """
+        raw_before = int(now - PRICE_HISTORY_RAW_RETENTION)
+        candles_before = {interval: int(now - retention) for interval, retention in PRICE_CANDLE_RETENTION.items()}
+        for crypto, currency in await self.db.get_price_history_pairs():
+            await self.db.prune_price_history(crypto, currency, raw_before, candles_before)
+    
+    async def get_last_price(self, crypto, currency, max_age=None):
+        """Последняя известная цена пары не старше max_age секунд или None"""
+        key = (crypto, currency.lower())
+        last = self._last.get(key) or await self.db.get_last_price(*key)
+        if not last or (max_age is not None and time.time() - last[0] > max_age):
+            return None
+        return last[1]
+    
+    async def get_candles(self, crypto, currency, interval=60, period=86400):
+        """Свечи [(начало, open, high, low, close)] за последние period секунд.
+        
+        interval - один из хранимых интервалов PRICE_CANDLE_RETENTION (60 или 3600).
+        """
+        if interval not in PRICE_CANDLE_RETENTION:
+            raise ValueError(f"Нет свечей с интервалом {interval} сек")
+        key = (crypto, currency.lower())
+        since = int(time.time() - period)
+        since -= since % interval
+        candles = {row[0]: tuple(row) for row in await self.db.get_candles(*key, interval, since)}
+        
+        # Точки, еще не записанные в базу
+        pending = [sample for sample in self._buffer if sample[:2] == key and sample[2] >= since]
+        for _, _, _, start, opened, high, low, close in self._to_candles(pending, interval):
+            stored = candles.get(start)
+            if stored:
+                candles[start] = (start, stored[1], max(stored[2], high), min(stored[3], low), close)
+            else:
+                candles[start] = (start, opened, high, low, close)
+        return [candles[start] for start in sorted(candles)]
+
+class PriceService:
+    def __init__(self, db):
+        self.db = db
+        self.history = PriceHistory(db)
+        self.session = None
+        self._inflight = {}
+        self.providers = ProviderRegistry([CoinGeckoProvider(self), BinanceProvider(self)])
+        self.fx_providers = ProviderRegistry([ExchangeRateApiProvider(self), CoinGeckoFxProvider(self)])
+        self._last_fx_rates = dict(FX_FALLBACK_RATES)
+        self.pool_stats = {
+            'requests': 0,
+            'connections_created': 0,
+            'connections_reused': 0,
+            'dns_cache_hits': 0,
+            'dns_cache_misses': 0
+        }
+    
+    async def start(self):
+        """Создает общую HTTP-сессию с пулом соединений"""
+        if self.session and not self.session.closed:
+            return
+        
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            use_dns_cache=True,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL
+        )
+        
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(self._trace_counter('requests'))
+        trace_config.on_connection_create_end.append(self._trace_counter('connections_created'))
+        trace_config.on_connection_reuseconn.append(self._trace_counter('connections_reused'))
+        trace_config.on_dns_cache_hit.append(self._trace_counter('dns_cache_hits'))
+        trace_config.on_dns_cache_miss.append(self._trace_counter('dns_cache_misses'))
+        
+        self.session = aiohttp.ClientSession(connector=connector, trace_configs=[trace_config])
+        logger.info(f"🌐 HTTP-сессия создана (пул: {HTTP_POOL_LIMIT}, на хост: {HTTP_POOL_LIMIT_PER_HOST})")
+    
+    async def close(self):
+        """Закрывает общую HTTP-сессию"""
+        if self.session and not self.session.closed:
+            await self.session.close()
+            logger.info(f"🌐 HTTP-сессия закрыта. Статистика пула: {self.get_pool_stats()}")
+        self.session = None
+        # Незавершенные запросы привязаны к текущему event loop - после перезапуска они не нужны
+        for future in self._inflight.values():
+            future.cancel()
+        self._inflight.clear()
+    
+    async def _get_session(self):
+        if not self.session or self.session.closed:
+            await self.start()
+        return self.session
+    
+    def _trace_counter(self, name):
+        async def handler(session, trace_config_ctx, params):
+            self.pool_stats[name] += 1
+        return handler
+    
+    def get_pool_stats(self):
+        """Статистика пула соединений с долей переиспользованных соединений"""
+        stats = dict(self.pool_stats)
+        connections = stats['connections_created'] + stats['connections_reused']
+        stats['reuse_rate'] = round(stats['connections_reused'] / connections, 3) if connections else 0.0
+        return stats
+    
+    def _start_flight(self, cache_key, fetch):
+        """Возвращает текущий запрос по ключу или запускает новый"""
+        future = self._inflight.get(cache_key)
+        if future is None:
+            future = asyncio.ensure_future(fetch())
+            self._inflight[cache_key] = future
+            
+            def _cleanup(done):
+                if self._inflight.get(cache_key) is done:
+                    del self._inflight[cache_key]
+                if not done.cancelled() and done.exception():
+                    logger.error(f"❌ Ошибка обновления {cache_key}: {done.exception()}")
+            
+            future.add_done_callback(_cleanup)
+        return future
+    
+    async def _single_flight(self, cache_key, fetch):
+        """Объединяет одновременные запросы по одному ключу в один сетевой запрос"""
+        future = self._start_flight(cache_key, fetch)
+        # shield - отмена одного ожидающего не отменяет запрос для остальных
+        return await asyncio.shield(future)
+    
+    def _needs_refresh(self, cache_key, ttl):
+        age = price_cache.age(cache_key)
+        return age is None or age >= ttl * 0.8
+    
+    async def warm_cache(self):
+        """Обновляет все горячие ключи до истечения срока их жизни"""
+        hot_keys = [
+            f"price_{crypto}_{target_currency}"
+            for crypto in CRYPTO_CURRENCIES
+            for target_currency in TARGET_CURRENCIES.values()
+        ]
+        
+        if any(self._needs_refresh(key, PRICE_CACHE_TTL) for key in hot_keys):
+            await self.refresh_prices()
+        
+        if self._needs_refresh("fx_usd", FX_CACHE_TTL):
+            await self._single_flight("fx_usd", self._fetch_fx_rates)
+    
+    async def get_fx_rates(self):
+        """Таблица курсов к USD {"rub": 95.1, "eur": 0.92, ...}, кэшируется на FX_CACHE_TTL"""
+        cached_rates = price_cache.get("fx_usd")
+        if cached_rates is not None:
+            return cached_rates
+        
+        return await self._single_flight("fx_usd", self._fetch_fx_rates)
+    
+    async def _fetch_fx_rates(self):
+        provider_name, rates = await self.fx_providers.call('fetch_rates')
+        
+        if rates:
+            rates['usd'] = 1.0
+            self._last_fx_rates = rates
+            logger.info(f"💰 Курсы валют обновлены ({provider_name}): {len(rates)} валют")
+            self._set_cache("fx_usd", rates, FX_CACHE_TTL)
+        else:
+            # Последняя известная таблица, а если ее нет - запасные значения.
+            # Кэшируем ненадолго, чтобы скоро повторить запрос
+            logger.warning("⚠️ Курсы валют недоступны, используем последние известные")
+            rates = self._last_fx_rates
+            self._set_cache("fx_usd", rates, PRICE_CACHE_TTL)
+        
+        return rates
+    
+    async def get_usd_multipliers(self):
+        """Множители из USD для всех TARGET_CURRENCIES, для которых известен курс"""
+        rates = await self.get_fx_rates()
+        return {
+            target_currency: rates[target_currency]
+            for target_currency in TARGET_CURRENCIES.values()
+            if target_currency in rates
+        }
+    
+    async def refresh_prices(self):
+        """Обновляет цены всех пар одним запросом к самому здоровому источнику"""
+        return await self._single_flight("price_matrix", self._fetch_prices)
+    
+    async def _fetch_prices(self, exclude=()):
+        provider_name, prices = await self.providers.call('fetch_prices', exclude)
+        if not prices:
+            return {}
+        
+        for (crypto, target_currency), price in prices.items():
+            self._set_cache(f"price_{crypto}_{target_currency}", price)
+            self.history.record(crypto, target_currency, price)
+        logger.info(f"✅ {provider_name}: получено {len(prices)} цен одним запросом")
+        return {'provider': provider_name, 'prices': prices}
+    
+    async def get_prices_batch(self, pairs, max_age=None):
+        """Возвращает словарь {(crypto, currency): price} для набора пар.
+
+        Все промахи кэша закрываются одним запросом к самому здоровому источнику,
+        недостающие в его ответе пары - одним запросом к следующему.
+        max_age - максимальный возраст цены из кэша в секундах.
+        """
+        prices = {}
+        missing = []
+
+        for crypto, currency in set(pairs):
+            if crypto not in CRYPTO_CURRENCIES:
+                prices[(crypto, currency)] = None
+                continue
+
+            cached_price = price_cache.get(f"price_{crypto}_{currency.lower()}", max_age)
+            if cached_price is not None:
+                prices[(crypto, currency)] = cached_price
+            else:
+                missing.append((crypto, currency))
+
+        if missing:
+            result = await self.refresh_prices()
+            matrix = result.get('prices', {})
+            not_found = [(crypto, currency) for crypto, currency in missing
+                         if matrix.get((crypto, currency.lower())) is None]
+
+            # Пары, которых нет в ответе, запрашиваем у остальных источников
+            if not_found and result:
+                fallback = await self._fetch_prices(exclude={result['provider']})
+                matrix = {**fallback.get('prices', {}), **matrix}
+
+            for crypto, currency in missing:
+                prices[(crypto, currency)] = matrix.get((crypto, currency.lower()))
+
+        return prices
+    
+    async def get_prices_within(self, pairs, timeout):
+        """Цены набора пар не дольше timeout секунд: {(crypto, currency): price или None}.
+        
+        Свежие и устаревшие значения берутся из кэша (устаревшие обновляются в фоне),
+        промахи закрываются одним пакетным запросом. Если он не успел к сроку,
+        пара получает None, а запрос продолжает работу и наполняет кэш.
+        """
+        prices = {}
+        missing = []
+        refresh = False
+        
+        for crypto, currency in set(pairs):
+            cache_key = f"price_{crypto}_{currency.lower()}"
+            price = price_cache.get(cache_key)
+            if price is None:
+                price = price_cache.get_stale(cache_key)
+                refresh = refresh or price is not None
+            if price is None:
+                missing.append((crypto, currency))
+            prices[(crypto, currency)] = price
+        
+        if missing:
+            batch = asyncio.ensure_future(self.get_prices_batch(missing))
+            # Ошибку запроса, завершившегося после дедлайна, забираем, чтобы asyncio о ней не предупреждал
+            batch.add_done_callback(lambda done: done.cancelled() or done.exception())
+            try:
+                prices.update(await asyncio.wait_for(asyncio.shield(batch), timeout))
+            except asyncio.TimeoutError:
+                logger.warning(f"⚠️ Цены не получены за {timeout} сек: {len(missing)} пар")
+            except Exception as e:
+                logger.error(f"❌ Ошибка получения цен: {e}")
+        elif refresh:
+            self._start_flight("price_matrix", self._fetch_prices)
+        
+        return prices
+    
+    async def convert_from_usd_all(self, usd_price):
+        """Цена из USD сразу во всех TARGET_CURRENCIES: {"rub": ..., "usd": ..., ...}"""
+        multipliers = await self.get_usd_multipliers()
+        return {target_currency: usd_price * rate for target_currency, rate in multipliers.items()}
+    
+    async def get_crypto_price(self, crypto, target_currency, allow_stale=False):
+        """allow_stale=True - вернуть устаревшую цену сразу и обновить ее в фоне"""
+        cache_key = f"price_{crypto}_{target_currency.lower()}"
+        cached_price = price_cache.get(cache_key)
+        if cached_price is not None:
+            return cached_price
+        
+        if allow_stale:
+            stale_price = price_cache.get_stale(cache_key)
+            if stale_price is not None:
+                # Отдаем старое значение сразу, а все цены обновляем одним запросом в фоне
+                self._start_flight("price_matrix", self._fetch_prices)
+                return stale_price
+        
+        prices = await self.get_prices_batch([(crypto, target_currency)])
+        return prices.get((crypto, target_currency))
+    
+    def get_provider_stats(self):
+        return {'prices': self.providers.get_stats(), 'fx': self.fx_providers.get_stats()}
+    
+    def _set_cache(self, cache_key, price, ttl=None):
+        price_cache.set(cache_key, price, ttl)
+
+class BinancePriceStream:
+    """Цены Binance в реальном времени через общий WebSocket-поток @miniTicker.
+    
+    Хранит последнюю цену каждой крипты в USD, переподключается с
+    экспоненциальной задержкой и вызывает on_price(crypto, usd_price) на каждый тик.
+    """
+    
+    def __init__(self, price_service, on_price, url=BINANCE_WS_URL):
+        self.price_service = price_service
+        self.on_price = on_price
+        self.url = url
+        self.last_prices = {}  # crypto -> последняя цена в USD
+        self.messages = 0
+        self.reconnects = 0
+        self._cryptos = {symbol: crypto for crypto, symbol in BINANCE_SYMBOLS.items()}
+        self._task = None
+    
+    def stream_url(self):
+        streams = "/".join(f"{symbol.lower()}@miniTicker" for symbol in BINANCE_SYMBOLS.values())
+        return f"{self.url}/stream?streams={streams}"
+    
+    async def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+            logger.info(f"✅ Поток Binance остановлен (сообщений: {self.messages}, переподключений: {self.reconnects})")
+    
+    async def _run(self):
+        backoff = 1
+        while True:
+            try:
+                session = await self.price_service._get_session()
+                async with session.ws_connect(self.stream_url(), heartbeat=30) as ws:
+                    logger.info("✅ Поток цен Binance подключен")
+                    backoff = 1
+                    async for msg in ws:
+                        if msg.type == aiohttp.WSMsgType.TEXT:
+                            await self._handle_message(msg.json())
+                        elif msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                            break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"⚠️ Поток Binance прерван: {e}")
+            
+            self.reconnects += 1
+            delay = min(backoff, BINANCE_WS_MAX_BACKOFF) * random.uniform(0.5, 1)
+            logger.info(f"🔄 Переподключение к Binance через {delay:.1f} сек")
+            await asyncio.sleep(delay)
+            backoff *= 2
+    
+    async def _handle_message(self, message):
+        # Комбинированный поток оборачивает тикер в {"stream": ..., "data": {...}}
+        data = message.get('data', message)
+        crypto = self._cryptos.get(data.get('s'))
+        if not crypto or 'c' not in data:
+            return
+        
+        usd_price = float(data['c'])
+        self.messages += 1
+        if self.last_prices.get(crypto) == usd_price:
+            return
+        
+        self.last_prices[crypto] = usd_price
+        try:
+            await self.on_price(crypto, usd_price)
         except Exception as e:
-            logger.error(f"❌ Ошибка получения курса USD/RUB: {e}")
-            return 95.0
-    
-    def _parse_exchange_rate(self, data):
-        if 'rates' in data and 'RUB' in data['rates']:
-            return float(data['rates']['RUB'])
-        elif 'usd' in data and 'rub' in data['usd']:
-            return float(data['usd']['rub'])
-        elif 'rub' in data:
-            return float(data['rub'])
-        return None
+            logger.error(f"❌ Ошибка обработки цены {crypto} из потока: {e}")
+
+class TokenBucket:
+    """Ограничитель скорости: rate токенов в секунду, не больше capacity подряд"""
+    
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+    
+    def try_acquire(self):
+        """Берет токен без ожидания: 0, если взят, иначе сколько секунд ждать следующего"""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+    
+    def is_idle(self):
+        self._refill()
+        return self.tokens >= self.capacity
+    
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class Notification:
+    """Одно уведомление: сообщения одному чату и позиция следующего к отправке.
+    
+    on_delivered() вызывается после первого доставленного сообщения,
+    on_dropped(reason) - если не доставлено ни одно. Причина постоянная ('forbidden',
+    'bad_request' - чат недоступен) или временная ('network', 'error', 'shutdown').
+    """
+    
+    __slots__ = ('chat_id', 'messages', 'position', 'attempt', 'delivered', 'failure', 'on_delivered', 'on_dropped')
+    
+    def __init__(self, chat_id, messages, on_delivered=None, on_dropped=None):
+        self.chat_id = chat_id
+        self.messages = messages
+        self.position = 0
+        self.attempt = 0
+        self.delivered = False
+        self.failure = None
+        self.on_delivered = on_delivered
+        self.on_dropped = on_dropped
+
+class NotificationDispatcher:
+    """Очередь исходящих уведомлений с пулом воркеров и лимитами Telegram.
+    
+    Воркер отправляет из уведомления одно сообщение и возвращает его в конец очереди,
+    поэтому воркеры чередуют чаты. Чат, исчерпавший свой лимит, откладывается
+    до появления токена и не занимает воркер. Сообщения одного уведомления
+    уходят по порядку, общий лимит соблюдается через TokenBucket.
+    """
+    
+    def __init__(self):
+        self.bot = None
+        self._queue = None
+        self._workers = []
+        self._timers = set()
+        self._slots = None
+        self._pending = set()  # принятые и еще не завершенные уведомления
+        self._idle = None
+        self._global_bucket = TokenBucket(NOTIFY_GLOBAL_RATE, NOTIFY_GLOBAL_RATE)
+        self._chat_buckets = {}
+        self.stats = {
+            'enqueued': 0,
+            'sent': 0,
+            'failed': 0,
+            'retries': 0
+        }
     
-    async def get_crypto_price_coingecko(self, currency_id, target_currency):
-        cache_key = f"coingecko_{currency_id}_{target_currency}"
-        if self._is_cache_valid(cache_key):
-            return price_cache[cache_key]['price']
+    async def start(self, bot):
+        if self._workers:
+            return
+        self.bot = bot
+        # Очередь без ограничения: в нее возвращаются уже принятые уведомления,
+        # а размер ограничивает _slots при постановке новых
+        self._queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(NOTIFY_QUEUE_SIZE)
+        self._pending = set()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        # Блокировки лимитеров привязываются к event loop, поэтому при каждом запуске они новые
+        self._global_bucket = TokenBucket(NOTIFY_GLOBAL_RATE, NOTIFY_GLOBAL_RATE)
+        self._chat_buckets = {}
+        self._workers = [
+            asyncio.create_task(self._worker(i)) for i in range(NOTIFY_WORKERS)
+        ]
+        logger.info(f"✅ Диспетчер уведомлений запущен ({NOTIFY_WORKERS} воркеров)")
+    
+    async def stop(self, timeout=None):
+        """Дожидается отправки всех уведомлений (не дольше timeout) и останавливает воркеры.
         
+        Для уведомлений, из которых не ушло ни одного сообщения, вызывается on_dropped('shutdown').
+        """
+        if not self._workers:
+            return
         try:
-            async with aiohttp.ClientSession() as session:
-                url = f"https://api.coingecko.com/api/v3/simple/price?ids={currency_id}&vs_currencies={target_currency}"
-                
-                async with session.get(url, timeout=10) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        if currency_id in data and target_currency in data[currency_id]:
-                            price = data[currency_id][target_currency]
-                            self._set_cache(cache_key, price)
-                            logger.info(f"✅ CoinGecko: {currency_id} = {price} {target_currency}")
-                            return price
-        except Exception as e:
-            logger.error(f"❌ CoinGecko ошибка: {e}")
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"⚠️ Не отправлено уведомлений: {len(self._pending)}")
+        for timer in self._timers:
+            timer.cancel()
+        self._timers.clear()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        for notification in list(self._pending):
+            await self._finish(notification, 'shutdown')
+        logger.info(f"✅ Диспетчер уведомлений остановлен. Статистика: {self.get_stats()}")
+    
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['queue_depth'] = len(self._pending)
+        stats['chat_buckets'] = len(self._chat_buckets)
+        return stats
+    
+    async def enqueue(self, chat_id, messages, on_delivered=None, on_dropped=None):
+        """Ставит в очередь список сообщений [(text, parse_mode), ...] для одного чата"""
+        await self._slots.acquire()
+        notification = Notification(chat_id, messages, on_delivered, on_dropped)
+        self._pending.add(notification)
+        self._idle.clear()
+        self._queue.put_nowait(notification)
+        self.stats['enqueued'] += 1
+    
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= NOTIFY_MAX_CHAT_BUCKETS:
+                # Забываем чаты, которые уже полностью восстановили лимит
+                for idle_chat_id in [c for c, b in self._chat_buckets.items() if b.is_idle()]:
+                    del self._chat_buckets[idle_chat_id]
+            bucket = TokenBucket(NOTIFY_CHAT_RATE, NOTIFY_CHAT_BURST)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+    
+    def _requeue(self, notification, delay=0):
+        if delay <= 0:
+            self._queue.put_nowait(notification)
+            return
         
-        return None
+        def wake():
+            self._timers.discard(timer)
+            self._queue.put_nowait(notification)
+        
+        timer = asyncio.get_running_loop().call_later(delay, wake)
+        self._timers.add(timer)
+    
+    async def _finish(self, notification, reason=None):
+        if notification not in self._pending:
+            return
+        self._pending.discard(notification)
+        self._slots.release()
+        if not self._pending:
+            self._idle.set()
+        if not notification.delivered and notification.on_dropped:
+            try:
+                await notification.on_dropped(reason or notification.failure or 'error')
+            except Exception as e:
+                logger.error(f"❌ Ошибка обработки неотправленного уведомления {notification.chat_id}: {e}")
+    
+    async def _worker(self, worker_id):
+        while True:
+            notification = await self._queue.get()
+            try:
+                wait = self._chat_bucket(notification.chat_id).try_acquire()
+                if wait > 0:
+                    # Чат упирается в свой лимит - воркер берет следующий чат
+                    self._requeue(notification, wait)
+                    continue
+                
+                await self._global_bucket.acquire()
+                was_delivered = notification.delivered
+                retry_after = await self._send(notification)
+                if notification.delivered and not was_delivered and notification.on_delivered:
+                    await notification.on_delivered()
+                
+                if retry_after is not None:
+                    self._requeue(notification, retry_after)
+                elif notification.position < len(notification.messages):
+                    self._requeue(notification)
+                else:
+                    await self._finish(notification)
+            except Exception as e:
+                logger.error(f"❌ Ошибка воркера уведомлений {worker_id}: {e}")
+                await self._finish(notification, 'error')
+            finally:
+                self._queue.task_done()
     
-    async def get_crypto_price_binance(self, currency_symbol, target_currency):
-        cache_key = f"binance_{currency_symbol}_{target_currency}"
-        if self._is_cache_valid(cache_key):
-            return price_cache[cache_key]['price']
+    async def _send(self, notification):
+        """Отправляет следующее сообщение уведомления.
         
+        Возвращает задержку перед повтором или None, если сообщение обработано
+        (при недоступном чате остальные сообщения отбрасываются).
+        """
+        chat_id = notification.chat_id
+        text, parse_mode = notification.messages[notification.position]
         try:
-            symbol = BINANCE_SYMBOLS.get(currency_symbol)
-            if not symbol:
+            await self.bot.send_message(chat_id, text, parse_mode=parse_mode)
+            self.stats['sent'] += 1
+            notification.delivered = True
+        except RetryAfter as e:
+            logger.warning(f"⚠️ Лимит Telegram, ждем {e.retry_after} сек")
+            self.stats['retries'] += 1
+            return float(e.retry_after)
+        except Forbidden as e:
+            # Пользователь заблокировал бота
+            logger.warning(f"⚠️ Чат {chat_id} недоступен: {e}")
+            self.stats['failed'] += 1
+            notification.failure = 'forbidden'
+            notification.position = len(notification.messages)
+            return None
+        except BadRequest as e:
+            logger.error(f"❌ Ошибка отправки уведомления {chat_id}: {e}")
+            self.stats['failed'] += 1
+            notification.failure = 'bad_request'
+            if not notification.delivered:
+                # Не ушло даже первое сообщение (чат не найден, аккаунт удален) - остальные тоже не уйдут
+                notification.position = len(notification.messages)
                 return None
-            
-            async with aiohttp.ClientSession() as session:
-                url = f"https://api.binance.com/api/v3/ticker/price?symbol={symbol}"
-                
-                async with session.get(url, timeout=10) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        usd_price = float(data['price'])
-                        
-                        if target_currency == "usd":
-                            self._set_cache(cache_key, usd_price)
-                            return usd_price
-                        
-                        # Конвертация в другие валюты
-                        if target_currency == "rub":
-                            usd_to_rub = await self.get_usd_to_rub_rate()
-                            rub_price = usd_price * usd_to_rub
-                            self._set_cache(cache_key, rub_price)
-                            logger.info(f"✅ Binance: {currency_symbol} = {rub_price:.2f} RUB")
-                            return rub_price
-                        else:
-                            rates = {"eur": 0.92, "kzt": 450.0, "uah": 38.0, "byn": 2.5}
-                            if target_currency in rates:
-                                converted_price = usd_price * rates[target_currency]
-                                self._set_cache(cache_key, converted_price)
-                                return converted_price
-                            return usd_price
-        except Exception as e:
-            logger.error(f"❌ Binance ошибка: {e}")
+        except NetworkError as e:
+            logger.warning(f"⚠️ Сетевая ошибка при отправке {chat_id}: {e}")
+            if notification.attempt < NOTIFY_MAX_RETRIES:
+                self.stats['retries'] += 1
+                notification.attempt += 1
+                return 2 ** (notification.attempt - 1)
+            self.stats['failed'] += 1
+            notification.failure = 'network'
         
+        notification.position += 1
+        notification.attempt = 0
         return None
-    
-    async def get_crypto_price(self, crypto, target_currency):
-        currency_id = CRYPTO_CURRENCIES[crypto]
-        target_currency_lower = target_currency.lower()
-        
-        # Пробуем CoinGecko
-        price = await self.get_crypto_price_coingecko(currency_id, target_currency_lower)
-        
-        # Если не сработало, пробуем Binance
-        if price is None:
-            price = await self.get_crypto_price_binance(crypto, target_currency_lower)
-        
-        return price
-    
-    def _is_cache_valid(self, cache_key):
-        if cache_key in price_cache:
-            cache_time = price_cache[cache_key]['timestamp']
-            return datetime.now() - cache_time < CACHE_DURATION
-        return False
-    
-    def _set_cache(self, cache_key, price):
-        price_cache[cache_key] = {
-            'price': price,
-            'timestamp': datetime.now()
-        }
 
 class BotService:
     def __init__(self):
-        self.db = Database()
-        self.price_service = PriceService()
+        self.db = AsyncDatabase(Database())
+        self.price_service = PriceService(self.db)
+        self.notifier = NotificationDispatcher()
         self.texts = {
             'ru': self._get_russian_texts(),
             'en': self._get_english_texts()
         }
+        self.screens, self.keyboards = self._build_screens()
+        # file_id главного фото после первой загрузки в Telegram
+        self.main_photo_id = None
+        self.main_photo_unique_id = None
     
     def _get_russian_texts(self):
         return {
@@ -341,7 +1984,27 @@ class BotService:
             'stop_all': "🛑 Остановить все подписки",
             'change_lang': "🌍 Сменить язык",
             'settings_text': "⚙️ <b>Настройки</b>\n\nЗдесь вы можете изменить язык бота.",
-            'language_changed_settings': "✅ <b>Язык успешно изменен!</b>\n\nТеперь бот будет использовать выбранный язык."
+            'language_changed_settings': "✅ <b>Язык успешно изменен!</b>\n\nТеперь бот будет использовать выбранный язык.",
+            'back': "🔙 Назад",
+            'currency_selection': """
+💎 <b>Криптовалюта:</b> {crypto}
+
+📊 <b>Текущие цены:</b>
+{price_info}
+
+💵 <b>Выберите валюту для покупки:</b>
+""",
+            'target_price_setup': """
+🎯 <b>Настройка мониторинга</b>
+
+💎 <b>Криптовалюта:</b> {crypto}
+💵 <b>Валюта:</b> {currency}
+
+💰 <b>Текущая цена:</b> {price_display}
+
+📝 <b>Введите целевую цену в {currency}:</b>
+<i>Например: 180.50</i>
+"""
         }
     
     def _get_english_texts(self):
@@ -398,7 +2061,27 @@ Channel: {channel}
             'stop_all': "🛑 Stop all subscriptions",
             'change_lang': "🌍 Change language",
             'settings_text': "⚙️ <b>Settings</b>\n\nHere you can change the bot language.",
-            'language_changed_settings': "✅ <b>Language successfully changed!</b>\n\nNow the bot will use the selected language."
+            'language_changed_settings': "✅ <b>Language successfully changed!</b>\n\nNow the bot will use the selected language.",
+            'back': "🔙 Back",
+            'currency_selection': """
+💎 <b>Cryptocurrency:</b> {crypto}
+
+📊 <b>Current prices:</b>
+{price_info}
+
+💵 <b>Choose purchase currency:</b>
+""",
+            'target_price_setup': """
+🎯 <b>Setup Monitoring</b>
+
+💎 <b>Cryptocurrency:</b> {crypto}
+💵 <b>Currency:</b> {currency}
+
+💰 <b>Current price:</b> {price_display}
+
+📝 <b>Enter target price in {currency}:</b>
+<i>Example: 180.50</i>
+"""
         }
     
     def get_text(self, lang, key, **kwargs):
@@ -407,13 +2090,93 @@ Channel: {channel}
             text = text.format(**kwargs)
         return text
     
+    def _build_screens(self):
+        """Заранее собирает тексты и клавиатуры, которые зависят только от языка"""
+        screens = {}    # (экран, язык) -> (текст, клавиатура)
+        keyboards = {}  # (экран, язык, крипта) -> клавиатура
+        
+        language_text = "🌍 <b>Choose your language / Выберите язык</b>"
+        crypto_list = list(CRYPTO_CURRENCIES.keys())
+        currency_list = list(TARGET_CURRENCIES.keys())
+        
+        for lang in self.texts:
+            back_menu = [InlineKeyboardButton(self.get_text(lang, 'back_menu'), callback_data="main_menu")]
+            
+            screens[('language_start', lang)] = (language_text, InlineKeyboardMarkup([
+                [InlineKeyboardButton("🇷🇺 Русский", callback_data="lang_ru")],
+                [InlineKeyboardButton("🇺🇸 English", callback_data="lang_en")]
+            ]))
+            screens[('language_settings', lang)] = (language_text, InlineKeyboardMarkup([
+                [InlineKeyboardButton("🇷🇺 Русский", callback_data="lang_ru_settings")],
+                [InlineKeyboardButton("🇺🇸 English", callback_data="lang_en_settings")],
+                [InlineKeyboardButton(self.get_text(lang, 'back'), callback_data="settings")]
+            ]))
+            screens[('subscription_check', lang)] = (
+                self.get_text(lang, 'check_subscription', channel=CHANNEL_USERNAME),
+                InlineKeyboardMarkup([
+                    [InlineKeyboardButton(self.get_text(lang, 'subscribe'), url=f"https://t.me/{CHANNEL_USERNAME[1:]}")],
+                    [InlineKeyboardButton(self.get_text(lang, 'check'), callback_data="check_subscription")]
+                ])
+            )
+            screens[('main_menu', lang)] = (self.get_text(lang, 'main_menu'), InlineKeyboardMarkup([
+                [InlineKeyboardButton(self.get_text(lang, 'setup_monitoring'), callback_data="setup_monitor")],
+                [InlineKeyboardButton(self.get_text(lang, 'my_subscriptions'), callback_data="mystats")],
+                [InlineKeyboardButton(self.get_text(lang, 'settings'), callback_data="settings")]
+            ]))
+            
+            crypto_keyboard = [
+                [InlineKeyboardButton(f"💎 {crypto}", callback_data=f"select_crypto_{crypto}") for crypto in crypto_list[i:i+2]]
+                for i in range(0, len(crypto_list), 2)
+            ]
+            crypto_keyboard.append(back_menu)
+            screens[('crypto_selection', lang)] = (self.get_text(lang, 'choose_crypto'), InlineKeyboardMarkup(crypto_keyboard))
+            
+            screens[('settings', lang)] = (self.get_text(lang, 'settings_text'), InlineKeyboardMarkup([
+                [InlineKeyboardButton(self.get_text(lang, 'change_lang'), callback_data="change_lang")],
+                back_menu
+            ]))
+            screens[('no_subscriptions', lang)] = (self.get_text(lang, 'no_subscriptions'), InlineKeyboardMarkup([back_menu]))
+            screens[('all_stopped', lang)] = (self.get_text(lang, 'all_stopped'), InlineKeyboardMarkup([back_menu]))
+            
+            keyboards[('back_menu', lang, None)] = InlineKeyboardMarkup([back_menu])
+            keyboards[('subscriptions', lang, None)] = InlineKeyboardMarkup([
+                [InlineKeyboardButton(self.get_text(lang, 'stop_all'), callback_data="stop_all")],
+                back_menu
+            ])
+            
+            for crypto in crypto_list:
+                currency_keyboard = [
+                    [InlineKeyboardButton(f"💵 {currency}", callback_data=f"select_currency_{crypto}_{currency}")
+                     for currency in currency_list[i:i+3]]
+                    for i in range(0, len(currency_list), 3)
+                ]
+                currency_keyboard.append([InlineKeyboardButton(self.get_text(lang, 'back_crypto'), callback_data="setup_monitor")])
+                keyboards[('currency_selection', lang, crypto)] = InlineKeyboardMarkup(currency_keyboard)
+                keyboards[('target_price', lang, crypto)] = InlineKeyboardMarkup([
+                    [InlineKeyboardButton(self.get_text(lang, 'back_crypto'), callback_data=f"select_crypto_{crypto}")]
+                ])
+        
+        return screens, keyboards
+    
+    def _markup(self, keyboard):
+        if keyboard is None or isinstance(keyboard, InlineKeyboardMarkup):
+            return keyboard
+        return InlineKeyboardMarkup(keyboard)
+    
     async def check_subscription(self, user_id, bot):
+        is_member = await self.db.get_membership(user_id)
+        if is_member is not None:
+            return is_member
+        
         try:
             member = await bot.get_chat_member(CHANNEL_USERNAME, user_id)
-            return member.status in ['member', 'administrator', 'creator']
+            is_member = member.status in CHANNEL_MEMBER_STATUSES
         except Exception as e:
             logger.error(f"❌ Ошибка проверки подписки: {e}")
             return False
+        
+        await self.db.set_membership(user_id, is_member)
+        return is_member
     
     async def send_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, keyboard=None):
         """Универсальная функция отправки сообщения"""
@@ -424,7 +2187,7 @@ Channel: {channel}
                 # Если это callback query, редактируем сообщение
                 await update.callback_query.message.edit_text(
                     text, 
-                    reply_markup=InlineKeyboardMarkup(keyboard) if keyboard else None,
+                    reply_markup=self._markup(keyboard),
                     parse_mode='HTML'
                 )
             else:
@@ -432,7 +2195,7 @@ Channel: {channel}
                 await context.bot.send_message(
                     chat_id=user_id,
                     text=text,
-                    reply_markup=InlineKeyboardMarkup(keyboard) if keyboard else None,
+                    reply_markup=self._markup(keyboard),
                     parse_mode='HTML'
                 )
             logger.info("✅ Сообщение отправлено")
@@ -440,24 +2203,79 @@ Channel: {channel}
         except Exception as e:
             logger.error(f"❌ Ошибка отправки сообщения: {e}")
     
+    async def load_main_photo(self):
+        """Берет сохраненный file_id главного фото, если он получен для текущего MAIN_PHOTO_URL"""
+        asset = await self.db.get_asset('main_photo')
+        if asset and asset[0] == MAIN_PHOTO_URL:
+            self.main_photo_id, self.main_photo_unique_id = asset[1], asset[2]
+            logger.info("✅ file_id главного фото загружен из базы")
+    
+    async def _remember_main_photo(self, message):
+        if self.main_photo_id or not message.photo:
+            return
+        photo = message.photo[-1]
+        self.main_photo_id, self.main_photo_unique_id = photo.file_id, photo.file_unique_id
+        await self.db.set_asset('main_photo', MAIN_PHOTO_URL, photo.file_id, photo.file_unique_id)
+        logger.info("✅ file_id главного фото сохранен")
+    
+    async def _edit_photo_message(self, message, text, reply_markup):
+        """Меняет экран в уже отправленном сообщении с фото вместо удаления и повторной отправки"""
+        try:
+            if self.main_photo_unique_id and message.photo[-1].file_unique_id == self.main_photo_unique_id:
+                await message.edit_caption(caption=text, reply_markup=reply_markup, parse_mode='HTML')
+            else:
+                edited = await message.edit_media(
+                    media=InputMediaPhoto(self.main_photo_id or MAIN_PHOTO_URL, caption=text, parse_mode='HTML'),
+                    reply_markup=reply_markup
+                )
+                if isinstance(edited, Message):
+                    await self._remember_main_photo(edited)
+        except BadRequest as e:
+            if 'message is not modified' not in str(e).lower():
+                raise
+    
     async def send_photo_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, keyboard):
         """Универсальная функция отправки фото с текстом"""
         user_id = update.effective_user.id
+        reply_markup = self._markup(keyboard)
         
         try:
             if update.callback_query:
+                message = update.callback_query.message
+                if message and message.photo:
+                    try:
+                        await self._edit_photo_message(message, text, reply_markup)
+                        logger.info("✅ Сообщение с фото изменено")
+                        return
+                    except Exception as e:
+                        logger.warning(f"⚠️ Не удалось изменить сообщение с фото: {e}")
                 try:
-                    await update.callback_query.message.delete()
+                    await message.delete()
                 except:
                     pass
             
-            await context.bot.send_photo(
-                chat_id=user_id,
-                photo=MAIN_PHOTO_URL,
-                caption=text,
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode='HTML'
-            )
+            try:
+                message = await context.bot.send_photo(
+                    chat_id=user_id,
+                    photo=self.main_photo_id or MAIN_PHOTO_URL,
+                    caption=text,
+                    reply_markup=reply_markup,
+                    parse_mode='HTML'
+                )
+            except BadRequest:
+                if not self.main_photo_id:
+                    raise
+                # Сохраненный file_id больше не действует - загружаем фото заново по ссылке
+                logger.warning("⚠️ Сохраненный file_id главного фото недействителен")
+                self.main_photo_id = self.main_photo_unique_id = None
+                message = await context.bot.send_photo(
+                    chat_id=user_id,
+                    photo=MAIN_PHOTO_URL,
+                    caption=text,
+                    reply_markup=reply_markup,
+                    parse_mode='HTML'
+                )
+            await self._remember_main_photo(message)
             logger.info("✅ Сообщение с фото отправлено")
             
         except Exception as e:
@@ -470,75 +2288,41 @@ Channel: {channel}
         source: 'start' - при запуске, 'settings' - из настроек
         """
         user_id = update.effective_user.id
-        current_lang = self.db.get_user_language(user_id)
-        
-        text = "🌍 <b>Choose your language / Выберите язык</b>"
-        
-        if source == "settings":
-            keyboard = [
-                [InlineKeyboardButton("🇷🇺 Русский", callback_data="lang_ru_settings")],
-                [InlineKeyboardButton("🇺🇸 English", callback_data="lang_en_settings")],
-                [InlineKeyboardButton("🔙 Назад" if current_lang == 'ru' else "🔙 Back", callback_data="settings")]
-            ]
-        else:
-            keyboard = [
-                [InlineKeyboardButton("🇷🇺 Русский", callback_data="lang_ru")],
-                [InlineKeyboardButton("🇺🇸 English", callback_data="lang_en")]
-            ]
+        current_lang = await self.db.get_user_language(user_id)
         
+        screen = 'language_settings' if source == "settings" else 'language_start'
+        text, keyboard = self.screens[(screen, current_lang)]
         await self.send_message(update, context, text, keyboard)
     
     async def show_subscription_check(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Показывает проверку подписки"""
         user_id = update.effective_user.id
-        lang = self.db.get_user_language(user_id)
-        
-        text = self.get_text(lang, 'check_subscription', channel=CHANNEL_USERNAME)
-        keyboard = [
-            [InlineKeyboardButton(self.get_text(lang, 'subscribe'), url=f"https://t.me/{CHANNEL_USERNAME[1:]}")],
-            [InlineKeyboardButton(self.get_text(lang, 'check'), callback_data="check_subscription")]
-        ]
+        lang = await self.db.get_user_language(user_id)
         
+        text, keyboard = self.screens[('subscription_check', lang)]
         await self.send_message(update, context, text, keyboard)
     
     async def show_main_menu_with_photo(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
-        lang = self.db.get_user_language(user_id)
+        lang = await self.db.get_user_language(user_id)
         
-        keyboard = [
-            [InlineKeyboardButton(self.get_text(lang, 'setup_monitoring'), callback_data="setup_monitor")],
-            [InlineKeyboardButton(self.get_text(lang, 'my_subscriptions'), callback_data="mystats")],
-            [InlineKeyboardButton(self.get_text(lang, 'settings'), callback_data="settings")]
-        ]
-        
-        text = self.get_text(lang, 'main_menu')
+        text, keyboard = self.screens[('main_menu', lang)]
         await self.send_photo_message(update, context, text, keyboard)
     
     async def show_crypto_selection(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
-        lang = self.db.get_user_language(user_id)
-        
-        keyboard = []
-        crypto_list = list(CRYPTO_CURRENCIES.keys())
+        lang = await self.db.get_user_language(user_id)
         
-        for i in range(0, len(crypto_list), 2):
-            row = []
-            for crypto in crypto_list[i:i+2]:
-                row.append(InlineKeyboardButton(f"💎 {crypto}", callback_data=f"select_crypto_{crypto}"))
-            keyboard.append(row)
-        
-        keyboard.append([InlineKeyboardButton(self.get_text(lang, 'back_menu'), callback_data="main_menu")])
-        
-        text = self.get_text(lang, 'choose_crypto')
+        text, keyboard = self.screens[('crypto_selection', lang)]
         await self.send_photo_message(update, context, text, keyboard)
     
     async def show_currency_selection(self, update: Update, context: ContextTypes.DEFAULT_TYPE, crypto: str):
         user_id = update.effective_user.id
-        lang = self.db.get_user_language(user_id)
+        lang = await self.db.get_user_language(user_id)
         
         # Получаем цены для всех валют
         price_tasks = [
-            self.price_service.get_crypto_price(crypto, currency)
+            self.price_service.get_crypto_price(crypto, currency, allow_stale=True)
             for currency in TARGET_CURRENCIES.keys()
         ]
         prices = await asyncio.gather(*price_tasks)
@@ -549,39 +2333,13 @@ Channel: {channel}
             for currency, price in zip(TARGET_CURRENCIES.keys(), prices)
         ])
         
-        # Создаем кнопки валют
-        keyboard = []
-        currency_list = list(TARGET_CURRENCIES.keys())
-        
-        for i in range(0, len(currency_list), 3):
-            row = []
-            for currency in currency_list[i:i+3]:
-                row.append(InlineKeyboardButton(f"💵 {currency}", callback_data=f"select_currency_{crypto}_{currency}"))
-            keyboard.append(row)
-        
-        keyboard.append([InlineKeyboardButton(self.get_text(lang, 'back_crypto'), callback_data="setup_monitor")])
-        
-        text = f"""
-💎 <b>Криптовалюта:</b> {crypto}
-
-📊 <b>Текущие цены:</b>
-{price_info}
-
-💵 <b>Выберите валюту для покупки:</b>
-""" if lang == 'ru' else f"""
-💎 <b>Cryptocurrency:</b> {crypto}
-
-📊 <b>Current prices:</b>
-{price_info}
-
-💵 <b>Choose purchase currency:</b>
-"""
-        
+        text = self.get_text(lang, 'currency_selection', crypto=crypto, price_info=price_info)
+        keyboard = self.keyboards[('currency_selection', lang, crypto)]
         await self.send_photo_message(update, context, text, keyboard)
     
     async def ask_for_target_price(self, update: Update, context: ContextTypes.DEFAULT_TYPE, crypto: str, currency: str):
         user_id = update.effective_user.id
-        lang = self.db.get_user_language(user_id)
+        lang = await self.db.get_user_language(user_id)
         
         context.user_data.update({
             'selected_crypto': crypto,
@@ -589,32 +2347,11 @@ Channel: {channel}
             'waiting_for_price': True
         })
         
-        current_price = await self.price_service.get_crypto_price(crypto, currency)
+        current_price = await self.price_service.get_crypto_price(crypto, currency, allow_stale=True)
         price_display = f"{current_price:,.2f} {currency}" if current_price else self.get_text(lang, 'loading')
         
-        text = f"""
-🎯 <b>Настройка мониторинга</b>
-
-💎 <b>Криптовалюта:</b> {crypto}
-💵 <b>Валюта:</b> {currency}
-
-💰 <b>Текущая цена:</b> {price_display}
-
-📝 <b>Введите целевую цену в {currency}:</b>
-<i>Например: 180.50</i>
-""" if lang == 'ru' else f"""
-🎯 <b>Setup Monitoring</b>
-
-💎 <b>Cryptocurrency:</b> {crypto}
-💵 <b>Currency:</b> {currency}
-
-💰 <b>Current price:</b> {price_display}
-
-📝 <b>Enter target price in {currency}:</b>
-<i>Example: 180.50</i>
-"""
-        
-        keyboard = [[InlineKeyboardButton(self.get_text(lang, 'back_crypto'), callback_data=f"select_crypto_{crypto}")]]
+        text = self.get_text(lang, 'target_price_setup', crypto=crypto, currency=currency, price_display=price_display)
+        keyboard = self.keyboards[('target_price', lang, crypto)]
         await self.send_photo_message(update, context, text, keyboard)
     
     async def handle_price_input(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -622,7 +2359,7 @@ Channel: {channel}
             return
         
         user_id = update.effective_user.id
-        lang = self.db.get_user_language(user_id)
+        lang = await self.db.get_user_language(user_id)
         
         try:
             price = float(update.message.text.replace(',', '.'))
@@ -635,7 +2372,7 @@ Channel: {channel}
                 return
             
             # Сохраняем подписку
-            success = self.db.save_subscription(user_id, crypto, currency, price)
+            success = await self.db.save_subscription(user_id, crypto, currency, price)
             
             if not success:
                 await update.message.reply_text("❌ Ошибка сохранения подписки")
@@ -673,7 +2410,7 @@ Channel: {channel}
 {status}
 """
             
-            keyboard = [[InlineKeyboardButton(self.get_text(lang, 'back_menu'), callback_data="main_menu")]]
+            keyboard = self.keyboards[('back_menu', lang, None)]
             await self.send_photo_message(update, context, text, keyboard)
             context.user_data.clear()
             
@@ -688,6 +2425,7 @@ bot_service = BotService()
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     logger.info(f"🔄 Пользователь {user_id} запустил бота")
+    await bot_service.db.remember_user(update.effective_user)
     
     # Всегда показываем выбор языка при старте
     logger.info(f"🌍 Показываем выбор языка для {user_id}")
@@ -700,6 +2438,7 @@ async def handle_button_click(update: Update, context: ContextTypes.DEFAULT_TYPE
     data = query.data
     user_id = query.from_user.id
     logger.info(f"🔄 Обработка кнопки: {data} от пользователя {user_id}")
+    await bot_service.db.remember_user(update.effective_user)
     
     # Обработка выбора языка
     if data.startswith("lang_"):
@@ -716,10 +2455,10 @@ async def handle_button_click(update: Update, context: ContextTypes.DEFAULT_TYPE
         logger.info(f"🌍 Пользователь {user_id} выбрал язык: {language}, источник: {source}")
         
         # Сохраняем язык в базу данных
-        success = bot_service.db.set_user_language(user_id, language)
+        success = await bot_service.db.set_user_language(user_id, language)
         
         if success:
-            lang = bot_service.db.get_user_language(user_id)
+            lang = await bot_service.db.get_user_language(user_id)
             
             if source == "settings":
                 # Если из настроек - показываем сообщение об успехе и возвращаем в настройки
@@ -747,7 +2486,7 @@ async def handle_button_click(update: Update, context: ContextTypes.DEFAULT_TYPE
             await bot_service.show_main_menu_with_photo(update, context)
         else:
             # Не подписан - показываем сообщение "вы не подписались!"
-            lang = bot_service.db.get_user_language(user_id)
+            lang = await bot_service.db.get_user_language(user_id)
             text = bot_service.get_text(lang, 'not_subscribed')
             await query.message.edit_text(text, parse_mode='HTML')
             
@@ -770,32 +2509,48 @@ async def handle_button_click(update: Update, context: ContextTypes.DEFAULT_TYPE
         await bot_service.show_language_selection(update, context, source="settings")
     elif data.startswith("select_crypto_"):
         crypto = data.replace("select_crypto_", "")
-        await bot_service.show_currency_selection(update, context, crypto)
+        if crypto in CRYPTO_CURRENCIES:
+            await bot_service.show_currency_selection(update, context, crypto)
     elif data.startswith("select_currency_"):
         parts = data.split("_")
         crypto = parts[2]
         currency = parts[3]
-        await bot_service.ask_for_target_price(update, context, crypto, currency)
+        if crypto in CRYPTO_CURRENCIES and currency in TARGET_CURRENCIES:
+            await bot_service.ask_for_target_price(update, context, crypto, currency)
 
 async def show_subscriptions(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     user_id = query.from_user.id
-    lang = bot_service.db.get_user_language(user_id)
+    lang = await bot_service.db.get_user_language(user_id)
     
-    subscriptions = bot_service.db.get_user_subscriptions(user_id)
-    keyboard = [[InlineKeyboardButton(bot_service.get_text(lang, 'back_menu'), callback_data="main_menu")]]
+    subscriptions = await bot_service.db.get_user_subscriptions(user_id)
     
     if not subscriptions:
-        text = bot_service.get_text(lang, 'no_subscriptions')
+        text, keyboard = bot_service.screens[('no_subscriptions', lang)]
         await bot_service.send_photo_message(update, context, text, keyboard)
         return
     
-    keyboard.insert(0, [InlineKeyboardButton(bot_service.get_text(lang, 'stop_all'), callback_data="stop_all")])
-    
+    keyboard = bot_service.keyboards[('subscriptions', lang, None)]
     text = "📊 <b>Ваши активные подписки:</b>\n\n" if lang == 'ru' else "📊 <b>Your active subscriptions:</b>\n\n"
     
+    # Все цены одним пакетным запросом с ограничением по времени
+    price_service = bot_service.price_service
+    prices = await price_service.get_prices_within(
+        [(crypto, currency) for crypto, currency, _ in subscriptions],
+        SUBSCRIPTIONS_PRICE_DEADLINE
+    )
+    
+    # Источники не ответили вовремя - берем последние цены из локальной истории
+    missing = [pair for pair, price in prices.items() if not price]
+    if missing:
+        fallback = await asyncio.gather(*(
+            price_service.history.get_last_price(crypto, currency, max_age=PRICE_HISTORY_FALLBACK_AGE)
+            for crypto, currency in missing
+        ))
+        prices.update(zip(missing, fallback))
+    
     for crypto, currency, target_price in subscriptions:
-        current_price = await bot_service.price_service.get_crypto_price(crypto, currency)
+        current_price = prices.get((crypto, currency))
         
         if current_price:
             difference = current_price - target_price
@@ -822,34 +2577,44 @@ async def show_subscriptions(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def stop_all_subscriptions(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     user_id = query.from_user.id
-    lang = bot_service.db.get_user_language(user_id)
+    lang = await bot_service.db.get_user_language(user_id)
     
-    bot_service.db.stop_all_subscriptions(user_id)
+    await bot_service.db.stop_all_subscriptions(user_id)
     
-    keyboard = [[InlineKeyboardButton(bot_service.get_text(lang, 'back_menu'), callback_data="main_menu")]]
-    text = bot_service.get_text(lang, 'all_stopped')
+    text, keyboard = bot_service.screens[('all_stopped', lang)]
     await bot_service.send_photo_message(update, context, text, keyboard)
 
 async def show_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     user_id = query.from_user.id
-    lang = bot_service.db.get_user_language(user_id)
-    
-    keyboard = [
-        [InlineKeyboardButton(bot_service.get_text(lang, 'change_lang'), callback_data="change_lang")],
-        [InlineKeyboardButton(bot_service.get_text(lang, 'back_menu'), callback_data="main_menu")]
-    ]
+    lang = await bot_service.db.get_user_language(user_id)
     
-    text = bot_service.get_text(lang, 'settings_text')
+    text, keyboard = bot_service.screens[('settings', lang)]
     await bot_service.send_photo_message(update, context, text, keyboard)
 
-async def send_spam(context, user_id, crypto, currency, current_price, target_price):
+async def track_channel_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обновляет кэш подписки по событиям канала (приходят, только если бот - администратор канала)"""
+    member_update = update.chat_member
+    if (member_update.chat.username or '').lower() != CHANNEL_USERNAME[1:].lower():
+        return
+    
+    member = member_update.new_chat_member
+    is_member = member.status in CHANNEL_MEMBER_STATUSES
+    await bot_service.db.set_membership(member.user.id, is_member)
+    logger.info(f"✅ Подписка на канал обновлена: {member.user.id} -> {is_member}")
+
+async def send_spam(user_id, crypto, currency, current_price, target_price):
+    # Забираем подписку из индекса: проверка по расписанию и поток цен
+    # не смогут отправить одно и то же уведомление дважды
+    if not bot_service.db.alert_index.remove(user_id, crypto, currency):
+        return
+    
     try:
-        # Получаем информацию о пользователе
-        user = await context.bot.get_chat(user_id)
-        username = f"@{user.username}" if user.username else f"user_{user_id}"
+        # username берем из своей базы, без запроса get_chat на каждое уведомление
+        username = await bot_service.db.get_username(user_id)
+        username = f"@{username}" if username else f"user_{user_id}"
         
-        lang = bot_service.db.get_user_language(user_id)
+        lang = await bot_service.db.get_user_language(user_id)
         
         if lang == 'ru':
             main_text = f"""
@@ -910,76 +2675,419 @@ async def send_spam(context, user_id, crypto, currency, current_price, target_pr
                 f"🎉 TIME TO ENTER THE DEAL! {username}"
             ]
         
-        # Отправляем основное сообщение
-        await context.bot.send_message(user_id, main_text, parse_mode='HTML')
+        async def on_delivered():
+            # Подписка отключается в базе только после доставки: если бот остановится
+            # раньше, после перезапуска алерт сработает снова
+            await bot_service.db.deactivate_subscription(user_id, crypto, currency, target_price)
         
-        # Отправляем 15 спам-сообщений
-        for i, msg in enumerate(spam_messages[:15], 1):
-            try:
-                await context.bot.send_message(user_id, f"{msg} [{i}/15]")
-                await asyncio.sleep(0.3)  # Небольшая задержка между сообщениями
-            except Exception as e:
-                logger.error(f"❌ Ошибка отправки спам-сообщения {i}: {e}")
-                continue
+        async def on_dropped(reason):
+            await drop_alert(user_id, crypto, currency, target_price, reason)
         
-        # Деактивируем подписку после отправки спама
-        bot_service.db.deactivate_subscription(user_id, crypto, currency)
-        logger.info(f"✅ Спам отправлен пользователю {username} ({user_id})")
+        # Основное сообщение и 15 спам-сообщений отправляет диспетчер в фоне
+        messages = [(main_text, 'HTML')]
+        messages += [(f"{msg} [{i}/15]", None) for i, msg in enumerate(spam_messages[:15], 1)]
+        await bot_service.notifier.enqueue(user_id, messages, on_delivered, on_dropped)
+        logger.info(f"✅ Спам поставлен в очередь для {username} ({user_id})")
         
     except Exception as e:
         logger.error(f"❌ Ошибка в send_spam: {e}")
+        await drop_alert(user_id, crypto, currency, target_price, 'error')
 
-async def check_prices(context: ContextTypes.DEFAULT_TYPE):
-    try:
-        db = Database()
-        subscriptions = []
+async def drop_alert(user_id, crypto, currency, target_price, reason):
+    """Алерт не доставлен: подписка отключается или возвращается в проверку"""
+    db = bot_service.db
+    if reason == 'shutdown':
+        # Подписка в базе активна - после перезапуска алерт сработает снова
+        db.restore_alert(user_id, crypto, currency, target_price)
+    elif reason in ('forbidden', 'bad_request'):
+        # Бот заблокирован, чат не найден или аккаунт удален - подписка больше не нужна
+        await db.deactivate_subscription(user_id, crypto, currency, target_price)
+    elif not db.retry_alert(user_id, crypto, currency, target_price):
+        logger.warning(f"⚠️ Алерт для {user_id} ({crypto}/{currency}) не доставлен за {ALERT_MAX_ATTEMPTS} попыток - подписка отключена")
+        await db.deactivate_subscription(user_id, crypto, currency, target_price)
+
+async def check_prices(context: ContextTypes.DEFAULT_TYPE, deadline, max_age=None):
+    """Один тик проверки цен. Возвращает цены и длительность каждой фазы"""
+    timings = {}
+    phase_started = time.monotonic()
+
+    # Загрузка: пары и подписки берутся из индекса в памяти
+    alert_index = bot_service.db.alert_index
+    pairs = alert_index.pairs()
+    timings['load'] = time.monotonic() - phase_started
+
+    logger.info(f"🔍 Проверка {len(alert_index)} подписок по {len(pairs)} парам")
+
+    # Получаем все нужные цены одним пакетом
+    phase_started = time.monotonic()
+    prices = await asyncio.wait_for(
+        bot_service.price_service.get_prices_batch(pairs, max_age),
+        timeout=max(deadline - phase_started, 0)
+    )
+    timings['fetch'] = time.monotonic() - phase_started
+
+    # Из индекса берутся только подписки с целью не ниже текущей цены
+    phase_started = time.monotonic()
+    triggered = [
+        (user_id, crypto, currency, current_price, target_price)
+        for (crypto, currency), current_price in prices.items() if current_price
+        for user_id, target_price in alert_index.triggered(crypto, currency, current_price)
+    ]
+    timings['evaluate'] = time.monotonic() - phase_started
+
+    phase_started = time.monotonic()
+    for i, (user_id, crypto, currency, current_price, target_price) in enumerate(triggered):
+        if time.monotonic() > deadline:
+            # Оставшиеся подписки активны и будут обработаны следующим тиком
+            logger.warning(f"⚠️ Бюджет тика исчерпан, отложено уведомлений: {len(triggered) - i}")
+            break
+        logger.info(f"🎯 ЦЕЛЬ ДОСТИГНУТА! {crypto}: {current_price} <= {target_price}")
+        await send_spam(user_id, crypto, currency, current_price, target_price)
+    timings['dispatch'] = time.monotonic() - phase_started
+
+    return prices, timings
+
+class PriceCheckScheduler:
+    """Планировщик проверок цен: запуски не накладываются друг на друга,
+    тик ограничен по времени, а интервал подстраивается под волатильность
+    """
+    
+    def __init__(self):
+        self.interval = PRICE_CHECK_INTERVAL
+        self.last_timings = {}
+        self.runs = 0
+        self.skipped = 0
+        self.overruns = 0
+        self._running = False
+        self._last_prices = {}
+    
+    def start(self, job_queue, first=10):
+        job_queue.run_once(self._run, when=first, name="check_prices")
+    
+    async def _run(self, context: ContextTypes.DEFAULT_TYPE):
+        try:
+            await self.run_once(context)
+        finally:
+            # Следующий запуск планируется только после завершения текущего
+            context.job_queue.run_once(self._run, when=self._next_delay(), name="check_prices")
+    
+    async def run_once(self, context: ContextTypes.DEFAULT_TYPE):
+        if self._running:
+            self.skipped += 1
+            logger.warning("⚠️ Предыдущая проверка цен еще идет - запуск пропущен")
+            return
+        
+        self._running = True
+        started = time.monotonic()
+        try:
+            prices, timings = await check_prices(
+                context,
+                deadline=started + PRICE_CHECK_BUDGET,
+                max_age=self.interval
+            )
+            self._adapt_interval(prices)
+            timings['total'] = time.monotonic() - started
+            self.last_timings = timings
+            self.runs += 1
+            logger.info(
+                "⏱ Проверка цен: " + ", ".join(f"{phase}={seconds:.3f}с" for phase, seconds in timings.items())
+                + f", следующий интервал {self.interval:.0f}с"
+            )
+            logger.info(f"📨 Очередь уведомлений: {bot_service.notifier.get_stats()}")
+            logger.info(f"🩺 Источники цен: {bot_service.price_service.get_provider_stats()}")
+            logger.info(f"🌐 Статистика HTTP пула: {bot_service.price_service.get_pool_stats()}")
+            logger.info(f"🗄 Статистика кэша цен: {price_cache.stats()}")
+        except asyncio.TimeoutError:
+            self.overruns += 1
+            logger.warning(f"⚠️ Проверка цен не уложилась в {PRICE_CHECK_BUDGET:.0f}с")
+        except Exception as e:
+            logger.error(f"❌ Ошибка в check_prices: {e}")
+        finally:
+            self._running = False
+    
+    def _adapt_interval(self, prices):
+        if not prices:
+            # Подписок нет - проверяем редко
+            self.interval = PRICE_CHECK_MAX_INTERVAL
+            return
         
-        with sqlite3.connect('crypto_bot.db', check_same_thread=False) as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT user_id, crypto, currency, target_price FROM subscriptions WHERE is_active = 1')
-            subscriptions = cursor.fetchall()
+        changes = [
+            abs(price - self._last_prices[pair]) / self._last_prices[pair]
+            for pair, price in prices.items()
+            if price and self._last_prices.get(pair)
+        ]
+        self._last_prices = {pair: price for pair, price in prices.items() if price}
         
-        logger.info(f"🔍 Проверка {len(subscriptions)} подписок")
+        if changes and max(changes) >= PRICE_CHECK_VOLATILITY:
+            self.interval = max(PRICE_CHECK_MIN_INTERVAL, self.interval / 2)
+        elif self.interval < PRICE_CHECK_INTERVAL:
+            self.interval = min(PRICE_CHECK_INTERVAL, self.interval * 1.5)
+        else:
+            self.interval = PRICE_CHECK_INTERVAL
+    
+    def _next_delay(self):
+        return self.interval * random.uniform(1 - PRICE_CHECK_JITTER, 1 + PRICE_CHECK_JITTER)
+
+price_check_scheduler = PriceCheckScheduler()
+
+async def on_stream_price(crypto, usd_price):
+    """Проверяет алерты по каждой новой цене из потока Binance"""
+    alert_index = bot_service.db.alert_index
+    price_service = bot_service.price_service
+    
+    converted_prices = await price_service.convert_from_usd_all(usd_price)
+    
+    for currency, target_currency in TARGET_CURRENCIES.items():
+        current_price = converted_prices.get(target_currency)
+        if current_price is None:
+            continue
+        price_service._set_cache(f"price_{crypto}_{target_currency}", current_price)
+        price_service.history.record(crypto, target_currency, current_price)
         
-        for user_id, crypto, currency, target_price in subscriptions:
-            current_price = await bot_service.price_service.get_crypto_price(crypto, currency)
-            
-            if current_price and current_price <= target_price:
-                logger.info(f"🎯 ЦЕЛЬ ДОСТИГНУТА! {crypto}: {current_price} <= {target_price}")
-                await send_spam(context, user_id, crypto, currency, current_price, target_price)
-                
+        if not alert_index.has_pair(crypto, currency):
+            continue
+        for user_id, target_price in alert_index.triggered(crypto, currency, current_price):
+            logger.info(f"🎯 ЦЕЛЬ ДОСТИГНУТА (поток)! {crypto}: {current_price} <= {target_price}")
+            await send_spam(user_id, crypto, currency, current_price, target_price)
+
+price_stream = BinancePriceStream(bot_service.price_service, on_stream_price)
+
+async def warm_price_cache(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await bot_service.price_service.warm_cache()
     except Exception as e:
-        logger.error(f"❌ Ошибка в check_prices: {e}")
+        logger.error(f"❌ Ошибка прогрева кэша цен: {e}")
 
-def main():
+async def flush_price_history(context: ContextTypes.DEFAULT_TYPE):
     try:
-        # Создаем приложение
-        app = Application.builder().token(BOT_TOKEN).build()
+        await bot_service.price_service.history.flush()
+    except Exception as e:
+        logger.error(f"❌ Ошибка записи истории цен: {e}")
+
+async def post_init(app: Application):
+    await bot_service.db.start()
+    if LANGUAGE_CACHE_PRELOAD:
+        await bot_service.db.preload_languages()
+    await bot_service.db.load_alert_index()
+    await bot_service.load_main_photo()
+    await bot_service.notifier.start(app.bot)
+    if BINANCE_STREAM:
+        await price_stream.start()
+    await bot_service.price_service.start()
+
+async def post_stop(app: Application):
+    """Прием обновлений и задачи уже остановлены, текущая проверка цен завершена.
+    
+    Бот еще может отправлять сообщения - дожидаемся очереди уведомлений и сохраняем данные.
+    """
+    await price_stream.stop()
+    await bot_service.notifier.stop(timeout=NOTIFY_DRAIN_TIMEOUT)
+    await bot_service.price_service.history.flush()
+    await bot_service.db.flush()
+
+async def post_shutdown(app: Application):
+    # Persistence сохраняет user_data при остановке Application - дописываем и эти записи
+    await bot_service.db.stop()
+    await bot_service.price_service.close()
+    logger.info("✅ Бот остановлен, данные сохранены")
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений разных пользователей.
+    
+    Обновления одного пользователя выполняются строго по очереди под его блокировкой,
+    поэтому состояние в context.user_data (например, waiting_for_price) не гоняется.
+    """
+    
+    # Ограничение базового класса отключено: его слот занимается до do_process_update,
+    # и обновления, ждущие своей очереди у одного пользователя, держали бы слоты остальных
+    UNLIMITED = 2 ** 31 - 1
+    
+    def __init__(self, max_concurrent_updates):
+        super().__init__(self.UNLIMITED)
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._locks = {}  # user_id -> [asyncio.Lock, число обновлений в работе]
+    
+    async def do_process_update(self, update, coroutine):
+        # Сначала очередь пользователя, потом общий слот
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            async with self._slots:
+                await coroutine
+            return
         
-        # Добавляем обработчики
-        app.add_handler(CommandHandler("start", start))
-        app.add_handler(CallbackQueryHandler(handle_button_click))
-        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, bot_service.handle_price_input))
+        entry = self._locks.setdefault(user.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._slots:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[user.id]
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        self._locks.clear()
+
+class WebhookServer:
+    """HTTP-сервер aiohttp, который принимает обновления Telegram и кладет их в update_queue"""
+    
+    def __init__(self, app, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET):
+        self.app = app
+        self.path = path
+        self.secret = secret
+        self._runner = None
+    
+    async def handle_update(self, request):
+        token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(token.encode(), self.secret.encode()):
+            logger.warning("⚠️ Webhook: запрос с неверным секретным токеном")
+            return web.Response(status=403)
         
-        # Пытаемся запустить JobQueue (если доступен)
         try:
-            if hasattr(app, 'job_queue') and app.job_queue:
-                app.job_queue.run_repeating(check_prices, interval=30, first=10)
-                logger.info("✅ JobQueue запущен для проверки цен")
-            else:
-                logger.warning("⚠️ JobQueue недоступен - уведомления о ценах не будут работать")
-        except Exception as job_error:
-            logger.warning(f"⚠️ Не удалось запустить JobQueue: {job_error}")
+            update = Update.de_json(await request.json(), self.app.bot)
+        except Exception as e:
+            logger.warning(f"⚠️ Webhook: некорректное обновление: {e}")
+            return web.Response(status=400)
         
-        logger.info("🎉 Бот полностью запущен и готов к работе на Railway!")
-        app.run_polling()
+        await self.app.update_queue.put(update)
+        return web.Response()
+    
+    def make_app(self):
+        web_app = web.Application()
+        web_app.router.add_post(self.path, self.handle_update)
+        return web_app
+    
+    async def start(self, host=WEBHOOK_LISTEN, port=WEBHOOK_PORT):
+        self._runner = web.AppRunner(self.make_app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info(f"✅ Webhook-сервер слушает {host}:{port}{self.path}")
+    
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+async def run_webhook(app: Application):
+    """Запуск через webhook: сервер, обработчики и задачи цен работают в одном event loop"""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+    
+    # Свой сервер вместо Updater: async with вызывает initialize()/shutdown(),
+    # а post_*-хуки PTB сам вызывает только в run_polling/run_webhook
+    server = WebhookServer(app)
+    try:
+        async with app:
+            if app.post_init:
+                await app.post_init(app)
+            await app.start()
+            try:
+                await server.start()
+                if WEBHOOK_URL:
+                    await app.bot.set_webhook(
+                        url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                        secret_token=WEBHOOK_SECRET,
+                        allowed_updates=ALLOWED_UPDATES
+                    )
+                    logger.info(f"✅ Webhook установлен: {WEBHOOK_URL}")
+                else:
+                    logger.warning("⚠️ WEBHOOK_URL не задан - webhook в Telegram не регистрируется")
+                
+                await stop_event.wait()
+            finally:
+                await server.stop()
+                await app.stop()
+                if app.post_stop:
+                    await app.post_stop(app)
+    finally:
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+
+def build_application():
+    # Создаем приложение
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+        .persistence(SQLitePersistence(bot_service.db))
+    )
+    if BOT_MODE == 'webhook':
+        builder = builder.updater(None)
+    app = builder.build()
+    
+    # Добавляем обработчики
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CallbackQueryHandler(handle_button_click))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, bot_service.handle_price_input))
+    app.add_handler(ChatMemberHandler(track_channel_member, ChatMemberHandler.CHAT_MEMBER))
+    
+    # Пытаемся запустить JobQueue (если доступен)
+    try:
+        if hasattr(app, 'job_queue') and app.job_queue:
+            price_check_scheduler.start(app.job_queue)
+            logger.info("✅ JobQueue запущен для проверки цен")
+            
+            if PRICE_CACHE_WARMUP:
+                app.job_queue.run_repeating(
+                    warm_price_cache,
+                    interval=PRICE_CACHE_TTL * 0.8,
+                    first=1
+                )
+                logger.info("✅ Фоновый прогрев кэша цен включен")
+            
+            app.job_queue.run_repeating(
+                flush_price_history,
+                interval=PRICE_HISTORY_FLUSH_INTERVAL,
+                first=PRICE_HISTORY_FLUSH_INTERVAL
+            )
+        else:
+            logger.warning("⚠️ JobQueue недоступен - уведомления о ценах не будут работать")
+    except Exception as job_error:
+        logger.warning(f"⚠️ Не удалось запустить JobQueue: {job_error}")
+    
+    return app
+
+def run_bot():
+    """Один запуск бота; возвращается после штатной остановки по SIGINT/SIGTERM"""
+    app = build_application()
+    logger.info(f"🎉 Бот полностью запущен и готов к работе на Railway! Режим: {BOT_MODE}")
+    if BOT_MODE == 'webhook':
+        asyncio.run(run_webhook(app))
+    else:
+        # run_polling закрывает свой event loop, поэтому каждому запуску нужен новый
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        app.run_polling(allowed_updates=ALLOWED_UPDATES)
+
+def main():
+    delay = RESTART_MIN_DELAY
+    while True:
+        started = time.monotonic()
+        try:
+            run_bot()
+            break
+        except Exception as e:
+            logger.error(f"❌ Критическая ошибка при запуске бота: {e}")
         
-    except Exception as e:
-        logger.error(f"❌ Критическая ошибка при запуске бота: {e}")
-        # Ждем перед перезапуском
-        time.sleep(10)
-        logger.info("🔄 Перезапуск бота...")
-        main()
+        # После долгой нормальной работы начинаем отсчет задержки заново
+        if time.monotonic() - started > RESTART_MAX_DELAY:
+            delay = RESTART_MIN_DELAY
+        logger.info(f"🔄 Перезапуск бота через {delay:.0f} сек...")
+        time.sleep(delay)
+        delay = min(delay * 2, RESTART_MAX_DELAY)
+    
+    asyncio.run(bot_service.db.close())
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# bot.py открывает базу при импорте - тесты работают со своей временной базой
+os.environ.setdefault('DB_PATH', os.path.join(tempfile.mkdtemp(), 'test.db'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,51 @@
+import asyncio
+from datetime import datetime
+
+from telegram import Chat, Message, Update, User
+
+import bot
+
+
+def make_update(update_id, user_id):
+    user = User(user_id, f"user{user_id}", False)
+    message = Message(update_id, datetime.now(), Chat(user_id, Chat.PRIVATE), from_user=user, text="x")
+    return Update(update_id, message=message)
+
+
+def test_updates_of_one_user_run_in_order_while_others_run_alongside():
+    async def scenario():
+        # Два слота: если бы a2 занял слот, ожидая a1, обновлению b1 места бы не осталось
+        processor = bot.PerUserUpdateProcessor(2)
+        events = []
+        first_started = asyncio.Event()
+        release_first = asyncio.Event()
+
+        async def handle(name, started=None, release=None):
+            events.append(f"{name} start")
+            if started:
+                started.set()
+            if release:
+                await release.wait()
+            events.append(f"{name} end")
+
+        async with processor:
+            first = asyncio.create_task(processor.process_update(
+                make_update(1, 1), handle("a1", first_started, release_first)
+            ))
+            await first_started.wait()
+            second = asyncio.create_task(processor.process_update(make_update(2, 1), handle("a2")))
+            other = asyncio.create_task(processor.process_update(make_update(3, 2), handle("b1")))
+
+            # Обновление другого пользователя проходит, пока первое еще выполняется
+            await asyncio.wait_for(other, 1)
+            assert "b1 end" in events
+            assert "a2 start" not in events
+
+            release_first.set()
+            await asyncio.wait_for(asyncio.gather(first, second), 1)
+
+        assert events.index("a1 end") < events.index("a2 start")
+        assert processor._locks == {}
+
+    asyncio.run(scenario())
+
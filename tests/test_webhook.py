@@ -0,0 +1,44 @@
+import asyncio
+from types import SimpleNamespace
+
+from aiohttp.test_utils import TestClient, TestServer
+from telegram import Update
+
+import bot
+
+SECRET = "test-secret"
+HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+async def post(body, headers):
+    app = SimpleNamespace(bot=None, update_queue=asyncio.Queue())
+    server = bot.WebhookServer(app, path="/telegram", secret=SECRET)
+    async with TestClient(TestServer(server.make_app())) as client:
+        response = await client.post("/telegram", data=body, headers=headers)
+        return response.status, app.update_queue
+
+
+def test_wrong_secret_is_rejected():
+    status, queue = asyncio.run(post('{"update_id": 1}', {HEADER: "wrong"}))
+    assert status == 403
+    assert queue.empty()
+
+
+def test_missing_secret_is_rejected():
+    status, queue = asyncio.run(post('{"update_id": 1}', {}))
+    assert status == 403
+    assert queue.empty()
+
+
+def test_bad_json_is_rejected():
+    status, queue = asyncio.run(post("not json", {HEADER: SECRET}))
+    assert status == 400
+    assert queue.empty()
+
+
+def test_update_is_queued():
+    status, queue = asyncio.run(post('{"update_id": 42}', {HEADER: SECRET}))
+    assert status == 200
+    update = queue.get_nowait()
+    assert isinstance(update, Update)
+    assert update.update_id == 42